@@ -3,158 +3,130 @@ assemble_data.py
     Data assembly from raw sources
 '''
 import os
+import numpy as np
 import pandas as pd
-import zipfile
-import shutil
-from sklearn.model_selection import ShuffleSplit
 from constants import *
 from buildVocab import CustAnalyzer
-
-if not os.path.isdir(RAW_DIR):
-    RAW_DIR = input("Raw data directory: ")
-
-# Loop the RAW_DIR
-if not os.path.isfile(f'{DATA_DIR}{SOURCE_DATASET}'):
-    for archive in os.listdir(RAW_DIR):
-        print(f'Processing {archive}...')
-        
-        # Unzip the archive to subfolder tmp/
-        with zipfile.ZipFile(RAW_DIR + archive) as zf:
-            zf.extractall(RAW_DIR + 'tmp/')
-
-        # Pull out the archive name
-        sample = archive[:-13]
-            
-        # Read in the verbatim data
-        verbatim = pd.read_csv(f'{RAW_DIR}tmp/{sample}VAERSDATA.csv', 
-                            encoding='latin1', error_bad_lines=False)\
-                            [['VAERS_ID', 'SYMPTOM_TEXT']]
-        # Read in the coded data
-        coded = pd.read_csv(f'{RAW_DIR}tmp/{sample}VAERSSYMPTOMS.csv', 
-                            encoding='latin1', error_bad_lines=False)
-        # Merge the two
-        df = verbatim.merge(coded, how='left', on='VAERS_ID')
-        
-        # Assign sample for tracing
-        df['SOURCE'] = sample
-
-        # If the compiled dataset exists then stack, else form
-        try:
-            compiled = pd.concat([df, compiled])
-        except:
-            compiled = df
-
-        # Remove the archive folder
-        shutil.rmtree(RAW_DIR + 'tmp/')
-
-    # Output the dataset
-    print(f'Writing data to {DATA_DIR}{SOURCE_DATASET}')
-    compiled.to_csv(f'{DATA_DIR}{SOURCE_DATASET}', index=False)
-
-else:
-    print('Skipping data assembled since file already exists')
-    compiled = pd.read_csv(f'{DATA_DIR}{SOURCE_DATASET}', low_memory=False)
-
-def join_symptoms(row):
-    ''' Turn symptoms into a list in a single var '''
-    out = []
-    for i in range(1,6):
-        if not pd.isna(row[f'SYMPTOM{i}']):
-            out.append(row[f'SYMPTOM{i}'])
-    return out
-
-print('Post-processing...')
-# Map the listing functions
-compiled['SYMPTOMS'] = compiled.apply(join_symptoms,axis=1)
-
-# Get rid of the numbered variables and keep the subset
-compiled = compiled[['VAERS_ID', 'SYMPTOM_TEXT', 'SYMPTOMS']]
-
-# Split off symptoms to merge into
-source = compiled[['VAERS_ID', 'SYMPTOM_TEXT']].copy()
-source.drop_duplicates(inplace=True) # We have duplicates here so remove
-
-# Pre-process the symptom text
-tokenize = CustAnalyzer(mask_dates=True)
-raw_tokenize = CustAnalyzer(mask_dates=True, max_length=None)
-
-source['TEXT'] = source.SYMPTOM_TEXT.apply(lambda x: ' '.join(tokenize(x)))
-source['RAW_TEXT'] = source.SYMPTOM_TEXT.apply(lambda x: ' '.join(raw_tokenize(x)))
-
-print('Aggregating labels...')
-# Aggregate the code list
-codes = compiled.groupby(['VAERS_ID'])['SYMPTOMS'].agg('sum').reset_index()
-
-# Merge into the final dataset
-final = source.merge(codes, on='VAERS_ID')
-
-# Join the lists together
-final['LABELS'] = final.SYMPTOMS.apply(lambda x: ';'.join(x))
-
-# Keep only the variables I want
-final = final[['VAERS_ID', 'TEXT', 'LABELS', 'RAW_TEXT']]
-
-# Write out
-print(f'Final dataset assembled. {final.shape[0]} records total.')
-print(f'Writing to {DATA_DIR}post_processed.csv...')
-final.to_csv(f'{DATA_DIR}post_processed.csv', index=False)
-
-# Record length for sorting purposes
-final['length'] = final.TEXT.apply(
-    lambda x: len(x.split() if not pd.isnull(x) else 0)
-    )
-
-# Filter out empty case reports
-final = final[final.length > 1]
-# Filter out missing labels
-final = final[pd.notna(final.LABELS)]
-
-# Create splits
-print('Creating Train/Test/Val splits...')
-
-# Create suffle split object
-splitter = ShuffleSplit(train_size=TRAIN_PROP, 
-                        test_size=TEST_PROP + VAL_PROP, 
-                        random_state=1234, 
-                        n_splits=1)
-
-# Split out the indices
-for train, test in splitter.split(final):
-    train_ind = train
-    devval_ind = test
-
-# Relative proportions of dev/val 
-test_prop = TEST_PROP / (TEST_PROP + VAL_PROP)
-val_prop = VAL_PROP / (TEST_PROP + VAL_PROP)
-
-# Split the test set from above again to get the dev and val sets
-splitter = ShuffleSplit(train_size=test_prop, 
-                        test_size=val_prop, 
-                        random_state=1234, 
-                        n_splits=1)
-
-# Split out the last two sets
-for test, val in splitter.split(devval_ind):
-    test_ind = devval_ind[test]
-    dev_ind = devval_ind[val]
-
-# Spit out the raw training records for the vocab build and embedding
-# training
-final[['RAW_TEXT']].iloc[train_ind]\
-    .to_csv(f'{DATA_DIR}/train_raw.csv')
-final.drop(['RAW_TEXT'], axis=1, inplace=True)
-
-# Write out the datasets
-train = final.iloc[train_ind]\
-    .sort_values(['length'])
-train.to_csv(f'{DATA_DIR}/train.csv')
-
-test = final.iloc[test_ind]\
-    .sort_values(['length'])
-test.to_csv(f'{DATA_DIR}/test.csv')
-
-dev = final.iloc[dev_ind]\
-    .sort_values(['length'])
-dev.to_csv(f'{DATA_DIR}/dev.csv')
-
-print('Done.')
\ No newline at end of file
+from datafuncs import assemble_archives, aggregate_symptoms, group_splits, read_assignments, \
+    write_assignments, write_columnar, SPLITS
+from dedup import find_near_duplicates
+from instrument import RunReport
+
+if __name__ == "__main__":
+    report = RunReport('assemble_data')
+
+    if not os.path.isdir(RAW_DIR):
+        RAW_DIR = input("Raw data directory: ")
+
+    # Merge the raw archives
+    if not os.path.isfile(f'{DATA_DIR}{SOURCE_DATASET}'):
+        with report.stage('merge') as stage:
+            rows = assemble_archives(RAW_DIR, f'{DATA_DIR}{SOURCE_DATASET}')
+            stage.count(rows)
+        print(f'Wrote {rows} rows to {DATA_DIR}{SOURCE_DATASET}')
+    else:
+        print('Skipping data assembled since file already exists')
+
+    with report.stage('ingest') as stage:
+        compiled = pd.read_csv(f'{DATA_DIR}{SOURCE_DATASET}', low_memory=False)
+        stage.count(compiled.shape[0])
+
+    print('Post-processing...')
+    print('Aggregating labels...')
+    # Collect the coded symptoms into one label list per report
+    with report.stage('aggregate') as stage:
+        codes = aggregate_symptoms(compiled)
+        stage.count(codes.shape[0])
+
+    # Get rid of the numbered variables and keep the subset
+    compiled = compiled[['VAERS_ID', 'SYMPTOM_TEXT']]
+
+    # Split off symptoms to merge into
+    source = compiled[['VAERS_ID', 'SYMPTOM_TEXT']].copy()
+    source.drop_duplicates(inplace=True) # We have duplicates here so remove
+
+    # Pre-process the symptom text, tokenizing each report once for both
+    # the truncated and the untruncated text
+    tokenize = CustAnalyzer(mask_dates=True)
+    with report.stage('tokenize') as stage:
+        tokens = list(tokenize.batch(source.SYMPTOM_TEXT, both=True))
+
+        source['TEXT'] = [' '.join(t[0]) for t in tokens]
+        source['RAW_TEXT'] = [' '.join(t[1]) for t in tokens]
+        source['length'] = [t[2] for t in tokens]
+        stage.count(len(tokens))
+        del tokens
+
+    # Merge into the final dataset
+    final = source.merge(codes, on='VAERS_ID')
+
+    # Keep only the variables I want, with length kept for sorting purposes
+    final = final[['VAERS_ID', 'TEXT', 'LABELS', 'RAW_TEXT', 'length']]
+
+    # Write out
+    print(f'Final dataset assembled. {final.shape[0]} records total.')
+    print(f'Writing to {DATA_DIR}post_processed.csv...')
+    final.drop(['length'], axis=1)\
+        .to_csv(f'{DATA_DIR}post_processed.csv', index=False)
+
+    # Filter out empty case reports
+    final = final[final.length > 1]
+    # Filter out missing labels
+    final = final[pd.notna(final.LABELS)]
+
+    # Group near-duplicate narratives such as follow up reports
+    groups = None
+    if NEAR_DUPLICATES:
+        print('Finding near-duplicate reports...')
+        with report.stage('near_duplicates') as stage:
+            groups = find_near_duplicates(final.TEXT.values, threshold=NEAR_DUP_THRESHOLD)
+            stage.count(len(groups))
+            stage.extra['groups'] = len(set(groups))
+        print(f'{final.shape[0] - len(set(groups))} near-duplicate reports found')
+        if NEAR_DUPLICATES == 'drop':
+            # Keep the first report of each group
+            keep = pd.Series(groups).drop_duplicates().index.values
+            final = final.iloc[keep]
+            groups = None
+
+    # Create splits
+    print('Creating Train/Test/Val splits...')
+
+    # Reports keep the split recorded for them by earlier releases. New
+    # reports join the split of their near-duplicate group, or a hash of its
+    # lowest VAERS_ID for new groups (see datafuncs.group_splits)
+    with report.stage('split') as stage:
+        assigned = read_assignments(f'{DATA_DIR}{SPLIT_ASSIGNMENTS}')
+        split = group_splits(final.VAERS_ID.values, groups, assigned)
+        write_assignments(f'{DATA_DIR}{SPLIT_ASSIGNMENTS}', final.VAERS_ID.values, split, assigned)
+        train_ind, test_ind, dev_ind = (np.flatnonzero(split == i) for i in range(len(SPLITS)))
+        stage.count(len(split))
+
+    with report.stage('write') as stage:
+        # Spit out the raw training records for the vocab build and embedding
+        # training, with their ids so vocab updates only count new reports
+        final[['VAERS_ID', 'RAW_TEXT']].iloc[train_ind]\
+            .to_csv(f'{DATA_DIR}/train_raw.csv', index=False)
+        final.drop(['RAW_TEXT'], axis=1, inplace=True)
+
+        # Write out the datasets
+        train = final.iloc[train_ind]\
+            .sort_values(['length'])
+        train.to_csv(f'{DATA_DIR}/train.csv')
+
+        test = final.iloc[test_ind]\
+            .sort_values(['length'])
+        test.to_csv(f'{DATA_DIR}/test.csv')
+
+        dev = final.iloc[dev_ind]\
+            .sort_values(['length'])
+        dev.to_csv(f'{DATA_DIR}/dev.csv')
+
+        # Columnar copies that load without any per row parsing
+        if WRITE_COLUMNAR:
+            print('Writing columnar splits...')
+            for name, split in (('train', train), ('test', test), ('dev', dev)):
+                write_columnar(split, f'{DATA_DIR}{name}/')
+        stage.count(final.shape[0])
+
+    print('Done.')
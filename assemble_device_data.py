@@ -7,51 +7,135 @@ assemble_device_data.py
 
 '''
 from tqdm import tqdm
+import io
 import os
 import zipfile
-import shutil
 import json
+from itertools import islice
 import pandas as pd
+from constants import *
 from buildVocab import CustAnalyzer
+from instrument import RunReport
 
-def extract_text(filename):
-    ''' Extract event text from the medical device event extract data'''
-    
-    events = []
-    with open(filename, 'r') as f:
-        data = json.loads(f.read())
-        
-    for result in event['results']:
-        for text in result['mdr_text']:
-            events += [text['text']]
-
-    return events
-
-# Loop the RAW_DIR
-all_events = []
-device_data_dir = "/home/stack/Documents/datasets/DEVICE/" 
-if not os.path.exists:
-    dev_data_dir = input("Location of device data: ")
-
-# Build tokenizer
-tokenize = CustAnalyzer(mask_dates=True, max_length=None)
-
-# Loop the zip archives
-for archive in tqdm(os.listdir(device_data_dir)):
-
-    # Unzip the archive to subfolder tmp/
-    with zipfile.ZipFile(device_data_dir + archive) as zf:
-        zf.extractall(device_data_dir + 'tmp/')
-    
-    # In case there are multiple files in the archive loop over
-    # the tmp folder
-    for file in os.listdir(device_data_dir + 'tmp/'):
-        tmp = extract_text(device_data_dir + 'tmp/' + file)
-        tmp = [' '.join(tokenize(x)) for x in tmp]
-        all_events += tmp
-        
-    # Remove the archive folder
-    shutil.rmtree(device_data_dir + 'tmp/')  
-
-# Output
-pd.DataFrame({'TEXT': all_events}).to_csv(f'{DATA_DIR}device_data.csv')
\ No newline at end of file
+class _JSONStream():
+    ''' Minimal incremental reader over a text stream of JSON, decoding
+        one value at a time so only the current value is in memory '''
+
+    def __init__(self, f, bufsize=1 << 16):
+        self.f = f
+        self.bufsize = bufsize
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        ''' Read more of the stream, dropping what was consumed '''
+        data = self.f.read(self.bufsize)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        ''' Next non-whitespace character, without consuming it '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        ''' Consume the next character, which must be one of chars '''
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f'Expected one of {chars!r} but found {char!r}')
+        self.pos += 1
+        return char
+
+    def value(self):
+        ''' Decode the next complete JSON value '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value running to the end of the buffer may be cut short
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def iter_results(f, key='results'):
+    ''' Incrementally yield each element of the top level results array
+        of an openFDA download, skipping the other top level values '''
+    stream = _JSONStream(f)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name == key:
+            stream.expect('[')
+            if stream.peek() != ']':
+                while True:
+                    yield stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+            else:
+                stream.expect(']')
+        else:
+            stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+def extract_text(f):
+    ''' Extract event text from the medical device event extract data,
+        streaming results[*].mdr_text[*].text from an open file '''
+    for result in iter_results(f):
+        for text in result.get('mdr_text', []):
+            yield text['text']
+
+def archive_text(archive):
+    ''' Stream the event text of every file in a zip archive, without
+        extracting it '''
+    with zipfile.ZipFile(archive) as zf:
+        # In case there are multiple files in the archive loop over them
+        for member in zf.namelist():
+            with zf.open(member) as raw:
+                yield from extract_text(io.TextIOWrapper(raw, encoding='utf-8'))
+
+if __name__ == "__main__":
+    # Loop the DEVICE_DIR
+    device_data_dir = DEVICE_DIR
+    if not os.path.exists(device_data_dir):
+        device_data_dir = input("Location of device data: ")
+
+    # Build tokenizer
+    tokenize = CustAnalyzer(mask_dates=True, max_length=None)
+
+    def all_text():
+        # Loop the zip archives
+        for archive in tqdm(sorted(os.listdir(device_data_dir))):
+            yield from archive_text(os.path.join(device_data_dir, archive))
+
+    # Tokenize in parallel and append to the output a batch at a time.
+    # Reading, tokenizing and writing are interleaved, so they are one stage
+    report = RunReport('assemble_device_data')
+    outfile = f'{DATA_DIR}device_data.csv'
+    written = 0
+    with report.stage('ingest_tokenize') as stage, open(outfile, 'w') as f:
+        events = (' '.join(x) for x in tokenize.batch(all_text()))
+        batch = list(islice(events, 10000))
+        while batch:
+            pd.DataFrame({'TEXT': batch}, index=range(written, written + len(batch)))\
+                .to_csv(f, header=(written == 0))
+            written += len(batch)
+            batch = list(islice(events, 10000))
+        stage.count(written)
+
+    print(f'Wrote {written} events to {outfile}')
@@ -0,0 +1,92 @@
+'''
+batching.py
+    Length bucketed batching over an encoded split (see encode_data.py).
+    Batches are padded with the PAD_CHAR index 0 up to the length of
+    their bucket instead of MAX_LENGTH
+'''
+import numpy as np
+
+from constants import *
+
+def default_boundaries(max_length=MAX_LENGTH):
+    ''' Powers of two from 16 up to max_length '''
+    boundaries = []
+    length = 16
+    while length < max_length:
+        boundaries.append(length)
+        length *= 2
+    return boundaries + [max_length]
+
+def quantile_boundaries(lengths, n_buckets):
+    ''' Bucket boundaries giving roughly equal sized buckets '''
+    qs = np.linspace(0, 100, n_buckets + 1)[1:]
+    return sorted(set(max(int(np.ceil(q)), 1) for q in np.percentile(lengths, qs)))
+
+class BucketIndex():
+    ''' Maps length boundaries to ranges of rows. Rows are taken in
+        length order, so for the splits written by assemble_data.py
+        (already sorted by length) every bucket is a contiguous range
+        of the split itself
+    '''
+
+    def __init__(self, offsets, boundaries=None):
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+        # Stable so an already sorted split keeps its own order
+        self.order = np.argsort(self.lengths, kind='mergesort')
+
+        if boundaries is None:
+            boundaries = default_boundaries(max(int(self.lengths.max()), 1)
+                                            if len(self.lengths) else 1)
+        self.boundaries = sorted(boundaries)
+        # Anything longer than the last boundary is truncated to it
+        if len(self.lengths) and self.lengths.max() > self.boundaries[-1]:
+            print(f'Truncating documents longer than {self.boundaries[-1]} tokens')
+
+        # (bucket length, start, end) over self.order
+        sorted_lengths = self.lengths[self.order]
+        ends = np.searchsorted(sorted_lengths, self.boundaries, side='right')
+        ends[-1] = len(sorted_lengths)
+        starts = np.concatenate([[0], ends[:-1]])
+        self.buckets = [(length, int(s), int(e))
+                        for length, s, e in zip(self.boundaries, starts, ends)
+                        if e > s]
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def batch_rows(self, batch_size, shuffle=False, seed=None):
+        ''' List of (bucket length, rows), one per batch. Shuffling
+            permutes the rows within each bucket and the order of the
+            batches across buckets
+        '''
+        rng = np.random.RandomState(seed)
+        batches = []
+        for length, start, end in self.buckets:
+            rows = self.order[start:end]
+            if shuffle:
+                rows = rng.permutation(rows)
+            for i in range(0, len(rows), batch_size):
+                batches.append((length, rows[i:i + batch_size]))
+
+        if shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def pad(self, tokens, rows, length):
+        ''' Copy rows into a (len(rows), length) array padded with 0 '''
+        out = np.zeros((len(rows), length), dtype=np.int32)
+        for i, row in enumerate(rows):
+            start = self.offsets[row]
+            end = min(self.offsets[row + 1], start + length)
+            out[i, :end - start] = tokens[start:end]
+        return out
+
+    def batches(self, tokens, label_matrix=None, batch_size=32,
+                shuffle=False, seed=None):
+        ''' Yields (rows, padded token batch, label batch). The label
+            batch is the matching rows of label_matrix, or None
+        '''
+        for length, rows in self.batch_rows(batch_size, shuffle, seed):
+            labels = label_matrix[rows] if label_matrix is not None else None
+            yield rows, self.pad(tokens, rows, length), labels
@@ -0,0 +1,499 @@
+'''
+benchmarks.py
+    Benchmarks for the data build pipeline. The tokenizer command is a
+    micro-benchmark of CustAnalyzer, the suite command builds synthetic
+    VAERS archives, device events and labels at a given scale and times
+    each pipeline stage in its own process, recording its throughput and
+    peak memory under BENCH_DIR for comparison across commits
+'''
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+
+from constants import *
+from buildVocab import CustAnalyzer
+from instrument import _cpu_seconds, _maxrss_mb
+
+class LegacyAnalyzer():
+    ''' The original multi-pass CustAnalyzer - date substitution,
+        sklearn tokenizer and a per-token number filter. Kept as
+        the reference the fused tokenizer is checked against
+    '''
+
+    def __init__(self, mask_dates, max_length=MAX_LENGTH):
+        v = CountVectorizer()
+        self.max_length = max_length
+        self.dat = re.compile(r'\b\d{1,2}\-?[a-z]{3}\-?\d{2,4}\b')
+        if mask_dates:
+            self.preprocess = lambda x: self.dat.sub('<DATE>', str(x).lower())
+        else:
+            self.preprocess = v.build_preprocessor()
+        self.tokenize = v.build_tokenizer()
+        self.is_num = re.compile(r'\b\d+\b')
+
+    def __call__(self, doc):
+        tokens = self.tokenize(self.preprocess(doc))
+        filtered = [t for t in tokens if not self.is_num.match(t)]
+        return filtered[:self.max_length]
+
+def time_call(func, docs, repeat=3):
+    ''' Best wall time of repeat passes of func over docs '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for doc in docs:
+            func(doc)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_tokenizer(docs, repeat=3):
+    ''' Compare the legacy and fused tokenizers in truncated and
+        untruncated mode. Asserts both give identical tokens.
+        Returns a list of result dicts
+    '''
+    results = []
+    for max_length in (MAX_LENGTH, None):
+        legacy = LegacyAnalyzer(mask_dates=True, max_length=max_length)
+        fused = CustAnalyzer(mask_dates=True, max_length=max_length)
+
+        # Token for token agreement before timing anything
+        for doc in docs:
+            assert legacy(doc) == fused(doc), f'Tokenizers disagree on: {doc!r}'
+
+        legacy_time = time_call(legacy, docs, repeat)
+        fused_time = time_call(fused, docs, repeat)
+        results.append({
+            'max_length': max_length,
+            'docs': len(docs),
+            'legacy_docs_per_sec': len(docs) / legacy_time,
+            'fused_docs_per_sec': len(docs) / fused_time,
+            'speedup': legacy_time / fused_time
+        })
+    return results
+
+BENCH_DIR = './bench_results/'
+
+# Number of reports, yearly archives, device events and labels per scale
+SCALES = {
+    'small': {'reports': 2000, 'archives': 2, 'device_events': 1000, 'labels': 300},
+    'medium': {'reports': 20000, 'archives': 4, 'device_events': 10000, 'labels': 2000},
+    'large': {'reports': 200000, 'archives': 8, 'device_events': 100000, 'labels': 11000},
+}
+
+class SyntheticText():
+    ''' Random narratives over a Zipf distributed vocabulary that also
+        holds dates and bare numbers, so date masking and the number
+        filter see realistic traffic '''
+
+    def __init__(self, rng, n_words=20000):
+        self.rng = rng
+        letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+        lengths = rng.randint(2, 11, n_words)
+        words = [''.join(rng.choice(letters, n)) for n in lengths]
+        months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                  'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+        words += ['%02d-%s-20%02d' % (rng.randint(1, 29), months[rng.randint(12)],
+                                      rng.randint(10, 22)) for _ in range(200)]
+        words += [str(x) for x in rng.randint(0, 1000, 200)]
+        self.words = np.array(words)
+        # Shuffled so the dates and numbers are spread over the ranks
+        rank = rng.permutation(len(words)) + 1
+        self.p = (1.0 / rank) / (1.0 / rank).sum()
+
+    def docs(self, n, mean_length=80):
+        ''' n documents with log-normal token counts, leaving a long
+            tail of documents past MAX_LENGTH '''
+        lengths = np.maximum(self.rng.lognormal(np.log(mean_length), 1.0, n), 1).astype(int)
+        tokens = self.words[self.rng.choice(len(self.words), lengths.sum(), p=self.p)]
+        ends = np.cumsum(lengths)
+        return [' '.join(tokens[e - l:e]).capitalize() + '.' for l, e in zip(lengths, ends)]
+
+def synthetic_labels(rng, n_labels, text):
+    ''' Unique capitalised two or three word label names '''
+    labels = set()
+    while len(labels) < n_labels:
+        n = rng.randint(2, 4)
+        labels.add(' '.join(rng.choice(text.words[:5000], n)).capitalize())
+    return sorted(labels)
+
+def write_vaers_archives(outdir, rng, text, labels, n_reports, n_archives):
+    ''' Yearly {year}VAERSData.zip archives holding the VAERSDATA and
+        VAERSSYMPTOMS CSVs. Reports with more than five symptoms get
+        several VAERSSYMPTOMS rows and about 5% of reports are lightly
+        edited copies of an earlier one, as follow up reports are
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    narratives = text.docs(n_reports)
+    copies = np.flatnonzero(rng.rand(n_reports) < 0.05)
+    for i in copies[copies > 0]:
+        narratives[i] = narratives[rng.randint(i)] + ' Follow up received.'
+
+    ids = np.arange(100000, 100000 + n_reports)
+    rank = np.arange(1, len(labels) + 1)
+    p = (1.0 / rank) / (1.0 / rank).sum()
+    for year, rows in enumerate(np.array_split(np.arange(n_reports), n_archives)):
+        symptoms = []
+        for vaers_id in ids[rows]:
+            codes = rng.choice(len(labels), rng.randint(1, 13), p=p)
+            for start in range(0, len(codes), 5):
+                row = {'VAERS_ID': vaers_id}
+                for j, code in enumerate(codes[start:start + 5], 1):
+                    row[f'SYMPTOM{j}'] = labels[code]
+                    row[f'SYMPTOMVERSION{j}'] = 23.1
+                symptoms.append(row)
+
+        data = pd.DataFrame({'VAERS_ID': ids[rows],
+                             'AGE_YRS': rng.randint(1, 90, len(rows)),
+                             'SYMPTOM_TEXT': [narratives[i] for i in rows]})
+        symptoms = pd.DataFrame(symptoms).reindex(
+            columns=['VAERS_ID'] + [f'{var}{i}' for i in range(1, 6)
+                                    for var in ('SYMPTOM', 'SYMPTOMVERSION')])
+        name = str(2000 + year)
+        with zipfile.ZipFile(os.path.join(outdir, f'{name}VAERSData.zip'), 'w',
+                             zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(f'{name}VAERSDATA.csv', data.to_csv(index=False))
+            zf.writestr(f'{name}VAERSSYMPTOMS.csv', symptoms.to_csv(index=False))
+
+def write_device_archives(outdir, rng, text, n_events, events_per_file=50000):
+    ''' openFDA style device-event-*.json.zip downloads, a meta block
+        then results with one to three mdr_text entries each '''
+    os.makedirs(outdir, exist_ok=True)
+    n_files = max(1, -(-n_events // events_per_file))
+    for part, events in enumerate(np.array_split(np.arange(n_events), n_files), 1):
+        counts = rng.randint(1, 4, len(events))
+        texts = iter(text.docs(int(counts.sum()), mean_length=60))
+        results = [{'report_number': str(e),
+                    'mdr_text': [{'text_type_code': 'Description of Event or Problem',
+                                  'text': next(texts)} for _ in range(c)]}
+                   for e, c in zip(events, counts)]
+        name = f'device-event-{part:04d}-of-{n_files:04d}.json'
+        with zipfile.ZipFile(os.path.join(outdir, name + '.zip'), 'w',
+                             zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(name, json.dumps({'meta': {'results': {'total': len(events)}},
+                                          'results': results}))
+
+def generate(workdir, reports, archives, device_events, labels, seed=1234):
+    ''' Write a full synthetic raw dataset under workdir '''
+    rng = np.random.RandomState(seed)
+    text = SyntheticText(rng)
+    label_list = synthetic_labels(rng, labels, text)
+    with open(os.path.join(workdir, 'labels.csv'), 'w') as f:
+        f.write('\n'.join(label_list) + '\n')
+    write_vaers_archives(os.path.join(workdir, 'raw'), rng, text, label_list,
+                         reports, archives)
+    write_device_archives(os.path.join(workdir, 'device'), rng, text, device_events)
+
+# Each stage benchmark takes the work directory, does any loading that
+# is not part of the stage and returns (function to time, documents).
+# Stages run in order and later stages read what earlier ones wrote
+
+def stage_assemble_archives(workdir):
+    from datafuncs import assemble_archives
+    raw = os.path.join(workdir, 'raw')
+    outfile = os.path.join(workdir, 'merged.csv')
+    return lambda: assemble_archives(raw, outfile), None
+
+def stage_aggregate_symptoms(workdir):
+    from datafuncs import aggregate_symptoms
+    compiled = pd.read_csv(os.path.join(workdir, 'merged.csv'), low_memory=False)
+    return lambda: aggregate_symptoms(compiled), compiled.VAERS_ID.nunique()
+
+def stage_tokenize(workdir):
+    from datafuncs import aggregate_symptoms
+    compiled = pd.read_csv(os.path.join(workdir, 'merged.csv'), low_memory=False)
+    codes = aggregate_symptoms(compiled)
+    source = compiled[['VAERS_ID', 'SYMPTOM_TEXT']].drop_duplicates()
+    tokenize = CustAnalyzer(mask_dates=True)
+
+    def run():
+        tokens = list(tokenize.batch(source.SYMPTOM_TEXT, both=True))
+        final = source.assign(TEXT=[' '.join(t[0]) for t in tokens])\
+            .merge(codes, on='VAERS_ID')
+        final[['VAERS_ID', 'TEXT', 'LABELS']]\
+            .to_csv(os.path.join(workdir, 'train_raw.csv'), index=False)
+    return run, source.shape[0]
+
+def stage_near_duplicates(workdir):
+    from dedup import find_near_duplicates
+    texts = pd.read_csv(os.path.join(workdir, 'train_raw.csv')).TEXT.fillna('').values
+    return lambda: find_near_duplicates(texts), len(texts)
+
+def stage_device_text(workdir):
+    from assemble_device_data import archive_text
+    device = os.path.join(workdir, 'device')
+    tokenize = CustAnalyzer(mask_dates=True, max_length=None)
+
+    def run():
+        texts = (t for a in sorted(os.listdir(device))
+                 for t in archive_text(os.path.join(device, a)))
+        events = [' '.join(x) for x in tokenize.batch(texts)]
+        pd.DataFrame({'TEXT': events}).to_csv(os.path.join(workdir, 'device_data.csv'))
+        return len(events)
+    return run, None
+
+def _corpus(workdir):
+    ''' The embedding corpus files, as create_embeddings.py uses them,
+        and their number of documents '''
+    files = {os.path.join(workdir, 'train_raw.csv'): 1,
+             os.path.join(workdir, 'device_data.csv'): 1}
+    return files, sum(pd.read_csv(f, usecols=[c]).shape[0] for f, c in files.items())
+
+def stage_build_vocab(workdir):
+    from buildVocab import build_vocab
+    files, docs = _corpus(workdir)
+
+    def run():
+        vocab, _ = build_vocab(files, mask_dates=True)
+        with open(os.path.join(workdir, 'vocab.csv'), 'w') as f:
+            f.write('\n'.join(vocab) + '\n')
+    return run, docs
+
+def stage_encode(workdir):
+    from buildVocab import Vocab
+    from encode_data import read_labels, encode_labels
+    vocab = Vocab.from_file(os.path.join(workdir, 'vocab.csv'))
+    l2ind = read_labels(os.path.join(workdir, 'labels.csv'))
+    df = pd.read_csv(os.path.join(workdir, 'train_raw.csv'))
+
+    def run():
+        vocab.encode(df.TEXT)
+        encode_labels(df.LABELS, l2ind)
+    return run, df.shape[0]
+
+def stage_corpus_file(workdir):
+    from word_embeddings import build_corpus_file
+    files, docs = _corpus(workdir)
+    corpus = os.path.join(workdir, 'corpus.txt')
+    return lambda: build_corpus_file(files, corpus), docs
+
+def stage_word2vec(workdir):
+    import gensim.models.word2vec as w2v
+    from word_embeddings import supports_corpus_file, word2vec_args
+    corpus = os.path.join(workdir, 'corpus.txt')
+    with open(corpus, 'r') as f:
+        docs = sum(1 for _ in f)
+
+    def run():
+        if supports_corpus_file():
+            model = w2v.Word2Vec(corpus_file=corpus, min_count=3, workers=4,
+                                 **word2vec_args(EMBEDDING_SIZE, 5))
+        else:
+            model = w2v.Word2Vec(w2v.LineSentence(corpus), min_count=3, workers=4,
+                                 **word2vec_args(EMBEDDING_SIZE, 5))
+        model.save(os.path.join(workdir, 'model.w2v'))
+    return run, docs
+
+def stage_embeddings(workdir):
+    import gensim
+    import extract_wvs
+    from buildVocab import Vocab
+    wv = gensim.models.Word2Vec.load(os.path.join(workdir, 'model.w2v')).wv
+    vocab = Vocab.from_file(os.path.join(workdir, 'vocab.csv'))
+    ind2w = {i: w for w, i in vocab.w2ind.items()}
+    outfile = os.path.join(workdir, 'embeddings.npy')
+
+    def run():
+        W, words = extract_wvs.build_matrix(ind2w, wv)
+        extract_wvs.save_embeddings(W, words, outfile)
+        extract_wvs.load_embeddings(outfile, seed=1234)
+    return run, len(vocab)
+
+STAGES = [
+    ('assemble_archives', stage_assemble_archives),
+    ('aggregate_symptoms', stage_aggregate_symptoms),
+    ('tokenize', stage_tokenize),
+    ('near_duplicates', stage_near_duplicates),
+    ('device_text', stage_device_text),
+    ('build_vocab', stage_build_vocab),
+    ('encode', stage_encode),
+    ('corpus_file', stage_corpus_file),
+    ('word2vec', stage_word2vec),
+    ('embeddings', stage_embeddings),
+]
+
+def _measure(stage, workdir, conn):
+    ''' Child process - run one stage and send back its measurements.
+        Being a fresh process, the peak RSS is this stage's alone '''
+    # Keep the stages' own progress output out of the report
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        func, docs = stage(workdir)
+        before = _maxrss_mb(resource.RUSAGE_SELF)
+        cpu = _cpu_seconds()
+        start = time.perf_counter()
+        out = func()
+        seconds = time.perf_counter() - start
+        # Stages without a known document count return it
+        docs = docs if docs is not None else out
+        result = {
+            'docs': int(docs),
+            'seconds': seconds,
+            'docs_per_sec': docs / seconds if seconds else None,
+            'cpu_seconds': _cpu_seconds() - cpu,
+            'peak_rss_mb': _maxrss_mb(resource.RUSAGE_SELF),
+            'rss_growth_mb': _maxrss_mb(resource.RUSAGE_SELF) - before,
+            'peak_worker_rss_mb': _maxrss_mb(resource.RUSAGE_CHILDREN),
+        }
+    except ImportError as e:
+        # e.g. gensim is not installed
+        result = {'skipped': str(e)}
+    except Exception as e:
+        result = {'error': f'{type(e).__name__}: {e}'}
+    conn.send(result)
+    conn.close()
+
+def run_stage(stage, workdir):
+    ''' Run a stage benchmark in its own (forked) process '''
+    ctx = get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measure, args=(stage, workdir, send))
+    proc.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = {'error': f'stage process exited with code {proc.exitcode}'}
+    proc.join()
+    return result
+
+def commit_id():
+    ''' Short commit hash, marked dirty when tracked files have changed '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain',
+                                         '--untracked-files=no']).strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_suite(scale='small', stages=None, workdir=None, seed=1234, **sizes):
+    ''' Generate the synthetic data for scale (any of SCALES' sizes
+        can be overridden) and benchmark the stages in order.
+        Returns the result dict
+    '''
+    sizes = dict(SCALES[scale], **{k: v for k, v in sizes.items() if v is not None})
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='vaers_bench_')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {
+        'commit': commit_id(),
+        'scale': scale,
+        'sizes': sizes,
+        'seed': seed,
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': {},
+    }
+    try:
+        start = time.perf_counter()
+        generate(workdir, seed=seed, **sizes)
+        results['generate_seconds'] = time.perf_counter() - start
+
+        for name, stage in STAGES:
+            if stages and name not in stages:
+                continue
+            print(f'{name}...', end=' ', flush=True)
+            result = run_stage(stage, workdir)
+            results['stages'][name] = result
+            print(format_result(result))
+    finally:
+        if not keep:
+            shutil.rmtree(workdir)
+    return results
+
+def format_result(result):
+    if 'skipped' in result:
+        return f"skipped ({result['skipped']})"
+    if 'error' in result:
+        return f"failed ({result['error']})"
+    return (f"{result['docs']} docs in {result['seconds']:.2f}s "
+            f"({result['docs_per_sec']:.0f} docs/s), "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB, "
+            f"workers {result['peak_worker_rss_mb']:.0f} MB")
+
+def results_file(commit, scale, bench_dir=BENCH_DIR):
+    return os.path.join(bench_dir, f'{commit}_{scale}.json')
+
+def save_results(results, bench_dir=BENCH_DIR):
+    os.makedirs(bench_dir, exist_ok=True)
+    outfile = results_file(results['commit'], results['scale'], bench_dir)
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=1)
+    return outfile
+
+def compare(results, baseline):
+    ''' Print the throughput and peak RSS of every stage against a
+        baseline result '''
+    print(f"{'stage':<20} {'docs/s':>10} {'baseline':>10} {'change':>8} "
+          f"{'RSS MB':>8} {'baseline':>9}")
+    for name, result in results['stages'].items():
+        base = baseline['stages'].get(name, {})
+        if 'docs_per_sec' not in result or 'docs_per_sec' not in base:
+            continue
+        change = result['docs_per_sec'] / base['docs_per_sec'] - 1
+        print(f"{name:<20} {result['docs_per_sec']:>10.0f} {base['docs_per_sec']:>10.0f} "
+              f"{change:>+8.1%} {result['peak_rss_mb']:>8.0f} {base['peak_rss_mb']:>9.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    # With no command, run the tokenizer benchmark on its defaults
+    parser.set_defaults(command='tokenizer', file=f'{DATA_DIR}device_data.csv',
+                        column=1, repeat=3)
+    commands = parser.add_subparsers(dest='command')
+
+    tokenizer = commands.add_parser('tokenizer', help='compare the fused and legacy tokenizers')
+    tokenizer.add_argument('--file', default=f'{DATA_DIR}device_data.csv',
+                           help='CSV holding the documents to tokenize')
+    tokenizer.add_argument('--column', type=int, default=1,
+                           help='Index of the text column')
+    tokenizer.add_argument('--repeat', type=int, default=3)
+
+    suite = commands.add_parser('suite', help='benchmark every stage on synthetic data')
+    suite.add_argument('--scale', choices=sorted(SCALES), default='small')
+    for size in SCALES['small']:
+        suite.add_argument(f'--{size.replace("_", "-")}', type=int, dest=size,
+                           help=f'override the {size} of the scale')
+    suite.add_argument('--stages', nargs='+', choices=[name for name, _ in STAGES],
+                       help='only these stages (their inputs must come from --workdir)')
+    suite.add_argument('--workdir', help='keep the synthetic data and outputs here')
+    suite.add_argument('--seed', type=int, default=1234)
+    suite.add_argument('--compare', metavar='COMMIT',
+                       help=f'compare against the stored results of COMMIT in {BENCH_DIR}')
+    args = parser.parse_args()
+
+    if args.command == 'suite':
+        # Read the baseline first, it may be the file about to be rewritten
+        baseline = None
+        if args.compare:
+            with open(results_file(args.compare, args.scale), 'r') as f:
+                baseline = json.load(f)
+        sizes = {size: getattr(args, size) for size in SCALES['small']}
+        results = run_suite(args.scale, args.stages, args.workdir, args.seed, **sizes)
+        print(f'Results written to {save_results(results)}')
+        if baseline:
+            compare(results, baseline)
+    else:
+        docs = pd.read_csv(args.file).iloc[:, args.column].dropna().tolist()
+        for result in bench_tokenizer(docs, args.repeat):
+            print(f"max_length={result['max_length']}: "
+                  f"legacy {result['legacy_docs_per_sec']:.0f} docs/s, "
+                  f"fused {result['fused_docs_per_sec']:.0f} docs/s "
+                  f"({result['speedup']:.2f}x)")
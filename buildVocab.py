@@ -3,75 +3,421 @@ buildVocab.py
     Builds vocabulary off of the provided data
     following CAML tokenization and preprocessing instructions
 '''
+import csv
+import json
+import os
+import numpy as np
 import pandas as pd
 import re
+from collections import Counter, deque
+from itertools import islice
+from multiprocessing import Pool
 from sklearn.feature_extraction.text import CountVectorizer
 
 from constants import *
+from datafuncs import file_sha256
+
+# Analyzer owned by each batch worker process
+_worker_analyzer = None
+
+def _init_worker(mask_dates, max_length):
+    ''' Pool initializer - build the analyzer once per worker '''
+    global _worker_analyzer
+    _worker_analyzer = CustAnalyzer(mask_dates, max_length=max_length)
+
+def _analyze_chunk(args):
+    ''' Pool worker - tokenize a chunk of documents '''
+    docs, both = args
+    if both:
+        return [_worker_analyzer.tokenize_both(d) for d in docs]
+    return [_worker_analyzer(d) for d in docs]
+
+def _chunks(iterable, size):
+    ''' Split an iterable into lists of at most size items '''
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+# Dates (e.g. 12-jan-2019) are masked as <DATE>
+DATE_PATTERN = r'\b\d{1,2}\-?[a-z]{3}\-?\d{2,4}\b'
+# sklearn's default token pattern, skipping isolated numbers
+TOKEN_PATTERN = r'(?u)\b(?!\d+\b)\w\w+\b'
+# Report id column of corpus files, so vocab updates only count new reports
+ID_COLUMN = 'VAERS_ID'
 
 # Create a custom analyzer for the the vectorizer object
 class CustAnalyzer():
     
     def __init__(self, mask_dates, max_length=MAX_LENGTH):
-        # Steal the defaul preprocessor and tokenizer from sklearn
-        v = CountVectorizer()
+        self.mask_dates = mask_dates
         self.max_length = max_length
-        self.dat = re.compile(r'\b\d{1,2}\-?[a-z]{3}\-?\d{2,4}\b')
-        if mask_dates:
-            self.preprocess = lambda x: self.dat.sub('<DATE>', str(x).lower())
-        else:
-            self.preprocess = v.build_preprocessor()
-        self.tokenize = v.build_tokenizer()
-        self.is_num = re.compile(r'\b\d+\b') # isolated numbers
-        
+        self.dat = re.compile(DATE_PATTERN)
+        # Tokenization and number filtering are fused into one pattern
+        # so no token is ever checked again in Python
+        self.tokenize = re.compile(TOKEN_PATTERN).findall
+        # Size in characters of the windows scanned in truncated mode
+        self.window = 4 * max_length if max_length else None
         
+    def lower(self, doc):
+        ''' Lowercase as sklearn's default preprocessor would '''
+        if self.mask_dates:
+            return str(doc).lower()
+        return doc.lower()
+
+    def mask(self, text):
+        ''' Mask dates in lowercased text if requested '''
+        if self.mask_dates:
+            return self.dat.sub('<DATE>', text)
+        return text
+
+    def filtered(self, doc):
+        ''' Clean and tokenize doc without any truncation '''
+        return self.tokenize(self.mask(self.lower(doc)))
+
     def __call__(self, doc):
-        # default clean and tokenize
-        doc_clean = self.preprocess(doc)
-        tokens = self.tokenize(doc_clean)
-        
-        # Return all tokens that aren't isolated numbers
-        filtered = [t for t in tokens if not self.is_num.match(t)]
-        if self.max_length:
-            return filtered[:self.max_length]
-        else:
-            return filtered[:self.max_length]
+        if self.max_length is None:
+            return self.filtered(doc)
 
-def build_vocab(filedict=None, outfile=None, mask_dates=False, max_length=MAX_LENGTH):
-    ''' Build up the vocab file from potentially multiple
-        sources 
-    '''
+        text = self.lower(doc)
+        # A token takes at least three characters with its separator, so
+        # only long documents can hold more than max_length tokens
+        if len(text) < 3 * self.max_length:
+            return self.tokenize(self.mask(text))[:self.max_length]
+
+        # Scan long documents in windows cut at spaces, so no date or
+        # token straddles two windows, and stop once enough are found
+        tokens = []
+        start = 0
+        while start < len(text) and len(tokens) < self.max_length:
+            end = text.find(' ', start + self.window)
+            if end < 0:
+                end = len(text)
+            tokens += self.tokenize(self.mask(text[start:end]))
+            start = end
+        return tokens[:self.max_length]
 
-    # initialize a series
-    corpus = pd.Series()
+    def tokenize_both(self, doc):
+        ''' Tokenize doc once and return the truncated tokens, the
+            untruncated tokens and the truncated token count '''
+        filtered = self.filtered(doc)
+        truncated = filtered[:self.max_length]
+        return truncated, filtered, len(truncated)
 
-    # Loop the dictionary
+    def batch(self, docs, n_jobs=None, chunksize=1000, both=False):
+        ''' Tokenize an iterable of documents over a process pool.
+            Yields the same output as calling the analyzer (or
+            tokenize_both if both is set) on each document, in order.
+            n_jobs defaults to all cores, n_jobs=1 runs in process
+        '''
+        if n_jobs == 1:
+            analyze = self.tokenize_both if both else self
+            for doc in docs:
+                yield analyze(doc)
+            return
+
+        # Only a few chunks per worker are in flight at once, so docs
+        # can be a stream larger than memory
+        max_pending = 2 * (n_jobs or os.cpu_count() or 1)
+        with Pool(n_jobs, initializer=_init_worker,
+                  initargs=(self.mask_dates, self.max_length)) as pool:
+            pending = deque()
+            for chunk in _chunks(docs, chunksize):
+                pending.append(pool.apply_async(_analyze_chunk, ((chunk, both),)))
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
+def _count_chunk(docs):
+    ''' Pool worker - document frequencies of a chunk of documents '''
+    return count_doc_freq(docs, _worker_analyzer)
+
+def count_doc_freq(docs, analyzer, doc_freq=None):
+    ''' Count the number of documents each token appears in. Tokens
+        are kept in order of first occurrence, as CountVectorizer does
+    '''
+    if doc_freq is None:
+        doc_freq = Counter()
+    for doc in docs:
+        # dict.fromkeys dedupes a document while keeping token order
+        doc_freq.update(dict.fromkeys(analyzer(doc), 1))
+    return doc_freq
+
+def read_corpus(filedict, chunksize=100000, skip=None):
+    ''' Yields (file, documents) for the non-empty documents of each
+        file in chunks. skip maps files to report ids whose rows are
+        left out, for files with an ID_COLUMN '''
     for file, column in filedict.items():
         print(f'Reading data {file}')
-           # Read and pull off selected column
-        tmp = pd.read_csv(f'{file}').iloc[:,column]
-        # Stack back to the main dataframe
-        corpus = corpus.append(tmp)
+        seen = (skip or {}).get(file)
+        for frame in pd.read_csv(f'{file}', chunksize=chunksize):
+            if seen is not None:
+                frame = frame[~frame[ID_COLUMN].isin(seen)]
+            # Pull off selected column
+            yield file, frame.iloc[:, column].dropna().tolist()
+
+def file_ids(file):
+    ''' Report ids of a corpus file, or None if it has no ID_COLUMN '''
+    if ID_COLUMN not in pd.read_csv(file, nrows=0).columns:
+        return None
+    return pd.read_csv(file, usecols=[ID_COLUMN])[ID_COLUMN].tolist()
+
+def stream_doc_freq(filedict, mask_dates=False, max_length=MAX_LENGTH, n_jobs=None,
+                    chunksize=1000, read_chunksize=100000, doc_freq=None, skip=None):
+    ''' Stream the files in chunks, counting document frequencies into
+        doc_freq, leaving out the reports in skip (see read_corpus).
+        Returns (doc_freq, number of documents per file)
+    '''
+    if doc_freq is None:
+        doc_freq = Counter()
+    sources = {file: 0 for file in filedict}
 
-    # Get the corpus
-    corpus = corpus.dropna()
+    if n_jobs == 1:
+        analyzer = CustAnalyzer(mask_dates, max_length=max_length)
+        for file, docs in read_corpus(filedict, read_chunksize, skip):
+            count_doc_freq(docs, analyzer, doc_freq)
+            sources[file] += len(docs)
+    else:
+        with Pool(n_jobs, initializer=_init_worker,
+                  initargs=(mask_dates, max_length)) as pool:
+            # One read chunk in flight at a time keeps memory bounded;
+            # merging in order keeps the first occurrence order
+            for file, docs in read_corpus(filedict, read_chunksize, skip):
+                for counts in pool.imap(_count_chunk, _chunks(docs, chunksize)):
+                    doc_freq.update(counts)
+                sources[file] += len(docs)
 
-    # Create the vectorizer
-    vectorizer = CountVectorizer(
-        min_df = 3, 
-        analyzer=CustAnalyzer(mask_dates, max_length=max_length), 
-        binary=True
-    )
+    return doc_freq, sources
+
+def count_sources(filedict, mask_dates=False, max_length=MAX_LENGTH, n_jobs=None,
+                  chunksize=1000, read_chunksize=100000):
+    ''' Document frequencies of each file on its own.
+        Returns {file: (doc_freq, number of documents)}
+    '''
+    counts = {}
+    for file, column in filedict.items():
+        doc_freq, sources = stream_doc_freq({file: column}, mask_dates, max_length, n_jobs,
+                                            chunksize, read_chunksize)
+        counts[file] = (doc_freq, sources[file])
+    return counts
+
+def merge_doc_freq(source_freq):
+    ''' Sum per file document frequencies in file order, which keeps
+        the first occurrence order of counting the files one after the
+        other '''
+    doc_freq = Counter()
+    for counts in source_freq.values():
+        doc_freq.update(counts)
+    return doc_freq
+
+def build_vocab(filedict=None, outfile=None, mask_dates=False, max_length=MAX_LENGTH,
+                n_jobs=None, min_df=3, chunksize=1000, read_chunksize=100000,
+                store=None):
+    ''' Build up the vocab file from potentially multiple
+        sources. Files are streamed in chunks and only document
+        frequencies are kept, so the corpus is never held in memory.
+        Matches fitting CountVectorizer(min_df=min_df, binary=True).
+        If store is given the document frequencies of every file are
+        saved there so update_vocab can add new reports or changed files
+        later
+    '''
+    print('Counting document frequencies...')
+    counts = count_sources(filedict, mask_dates, max_length, n_jobs,
+                           chunksize, read_chunksize)
+    source_freq = {file: c[0] for file, c in counts.items()}
+    doc_freq = merge_doc_freq(source_freq)
 
-    print('Fitting vectorizer...')
-    # Fit to the corpus
-    vectorizer.fit(corpus)
+    vocab = threshold_vocab(doc_freq, min_df)
+    print(f'Found {len(vocab)} tokens in {sum(c[1] for c in counts.values())} documents')
 
     if outfile:
-        print(f'Found {len(vectorizer.vocabulary_.keys())}) tokens')
-        print(f'Writing out to {VOCAB_DIR}{outfile}...')
-        with open(f'{VOCAB_DIR}{outfile}', 'w') as vocab_file:
-            for word in vectorizer.vocabulary_.keys():
-                vocab_file.write(word + "\n")
-    
-    return vectorizer.vocabulary_, vectorizer
\ No newline at end of file
+        write_vocab(vocab, outfile)
+    if store:
+        sources = {file: {'docs': c[1], 'sha256': file_sha256(file), 'ids': file_ids(file)}
+                   for file, c in counts.items()}
+        save_doc_freq(store, source_freq, sources, mask_dates, max_length, min_df)
+
+    # Hand back a vectorizer fixed to the vocabulary
+    analyzer = CustAnalyzer(mask_dates, max_length=max_length)
+    vectorizer = CountVectorizer(vocabulary=vocab, analyzer=analyzer, binary=True)
+    return vocab, vectorizer
+
+def save_doc_freq(store, source_freq, sources, mask_dates, max_length, min_df):
+    ''' Persist the document frequencies of every file along with the
+        number of documents, content hash and (for files with an
+        ID_COLUMN) counted report ids of each file, and the analyzer
+        settings and threshold used '''
+    with open(store, 'w') as f:
+        json.dump({
+            'min_df': min_df,
+            'mask_dates': mask_dates,
+            'max_length': max_length,
+            'sources': sources,
+            'source_freq': source_freq
+        }, f)
+
+def load_doc_freq(store):
+    ''' Load a store written by save_doc_freq.
+        Returns (source_freq, sources, mask_dates, max_length, min_df)
+    '''
+    with open(store, 'r') as f:
+        data = json.load(f)
+    if 'source_freq' not in data:
+        raise ValueError(f'{store} has no per file counts, rebuild it with '
+                         f'build_vocab(store={store!r})')
+    source_freq = {file: Counter(counts) for file, counts in data['source_freq'].items()}
+    return (source_freq, data['sources'],
+            data['mask_dates'], data['max_length'], data['min_df'])
+
+def update_vocab(filedict, store=f'{VOCAB_DIR}doc_freq.json', outfile='vocab.csv',
+                 min_df=3, n_jobs=None, chunksize=1000, read_chunksize=100000):
+    ''' Bring a persisted document frequency store up to date with
+        filedict and re-threshold the vocabulary at min_df, reporting the
+        tokens that entered or left since the last threshold. Files with
+        an ID_COLUMN, such as train_raw.csv which every release rewrites
+        with the whole history, only have their reports not counted before
+        counted and added to their stored frequencies. Other files are
+        recounted when their content hash changes and skipped otherwise.
+        The vocab matches a full rebuild over the files.
+        Returns (vocab, tokens that entered, tokens that left)
+    '''
+    source_freq, sources, mask_dates, max_length, old_min_df = load_doc_freq(store)
+    old_vocab = threshold_vocab(merge_doc_freq(source_freq), old_min_df)
+
+    counted = 0
+    added = 0
+    for file, column in filedict.items():
+        digest = file_sha256(file)
+        known = sources.get(file)
+        if known and known['sha256'] == digest:
+            print(f'Skipping {file}, unchanged since it was counted')
+            continue
+
+        ids = file_ids(file)
+        seen = set(known['ids']) if known and known.get('ids') is not None else None
+        if seen is not None and ids is not None and seen.issubset(ids):
+            # Only the reports added since the last count
+            new = len(set(ids) - seen)
+            print(f'Counting {new} new reports of {file}')
+            doc_freq, docs = stream_doc_freq({file: column}, mask_dates, max_length, n_jobs,
+                                             chunksize, read_chunksize,
+                                             doc_freq=source_freq[file], skip={file: seen})
+            docs = known['docs'] + docs[file]
+        else:
+            if known:
+                print(f'Recounting {file}, changed since it was counted')
+            doc_freq, docs = stream_doc_freq({file: column}, mask_dates, max_length, n_jobs,
+                                             chunksize, read_chunksize)
+            docs = docs[file]
+        counted += 1
+        added += docs - (known['docs'] if known else 0)
+        source_freq[file] = doc_freq
+        sources[file] = {'docs': docs, 'sha256': digest, 'ids': ids}
+
+    vocab = threshold_vocab(merge_doc_freq(source_freq), min_df)
+    entered = [t for t in vocab if t not in old_vocab]
+    left = [t for t in old_vocab if t not in vocab]
+    print(f'Counted {counted} new or changed files ({added:+d} documents): '
+          f'{len(entered)} tokens entered and {len(left)} left the vocabulary '
+          f'({len(vocab)} total)')
+
+    if outfile:
+        write_vocab(vocab, outfile)
+    save_doc_freq(store, source_freq, sources, mask_dates, max_length, min_df)
+    return vocab, entered, left
+
+def threshold_vocab(doc_freq, min_df):
+    ''' Tokens with a document frequency of at least min_df, in first
+        occurrence order, mapped to their sorted position
+    '''
+    kept = [t for t, n in doc_freq.items() if n >= min_df]
+    position = {t: i for i, t in enumerate(sorted(kept))}
+    return {t: position[t] for t in kept}
+
+def write_vocab(vocab, outfile):
+    ''' Write the vocabulary out to VOCAB_DIR, one token per line '''
+    print(f'Writing out to {VOCAB_DIR}{outfile}...')
+    with open(f'{VOCAB_DIR}{outfile}', 'w') as vocab_file:
+        for word in vocab.keys():
+            vocab_file.write(word + "\n")
+
+class Vocab():
+    ''' Word to index mapping used across the pipeline. Words are
+        indexed in sorted order starting at 1, with 0 saved for the
+        pad character and len(words) + 1 used for unknown words
+    '''
+
+    def __init__(self, words):
+        self.ind2w = [PAD_CHAR] + sorted(set(words))
+        self.w2ind = {w: i for i, w in enumerate(self.ind2w) if i > 0}
+        self.pad_id = 0
+        self.unk_id = len(self.ind2w)
+
+    @classmethod
+    def from_file(cls, vocab_file=f'{VOCAB_DIR}vocab.csv'):
+        ''' Read a vocab file written by build_vocab '''
+        with open(vocab_file, 'r') as f:
+            return cls(line.strip() for line in f if line.strip() != '')
+
+    def __len__(self):
+        return len(self.w2ind)
+
+    def __contains__(self, word):
+        return word in self.w2ind
+
+    def encode(self, docs):
+        ''' Map documents (token lists or space joined strings) to
+            indices in one flat array.
+            Returns (ids, offsets) where document i is
+            ids[offsets[i]:offsets[i + 1]]
+        '''
+        docs = [d.split() if isinstance(d, str) else (d if isinstance(d, list) else [])
+                for d in docs]
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum([len(doc) for doc in docs], out=offsets[1:])
+        return self.encode_tokens((t for doc in docs for t in doc), offsets)
+
+    def encode_tokens(self, tokens, offsets):
+        ''' encode for documents already flattened into one token
+            sequence with document offsets (see datafuncs.split_tokens) '''
+        get = self.w2ind.get
+        unk = self.unk_id
+        return np.fromiter((get(t, unk) for t in tokens), dtype=np.int32), offsets
+
+    def decode(self, ids):
+        ''' Map indices back to words, unknown words as None '''
+        return [self.ind2w[i] if i < self.unk_id else None for i in ids]
+
+def write_description_vectors(outfile, keys, ids, offsets):
+    ''' Write one row per key - the key followed by its encoded
+        document - space delimited under a CODE VECTOR header '''
+    with open(outfile, 'w+') as f:
+        w = csv.writer(f, delimiter=' ')
+        w.writerow(['CODE', 'VECTOR'])
+        ids = ids.tolist()
+        w.writerows([key] + ids[s:e] for key, s, e in zip(keys, offsets[:-1], offsets[1:]))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Update the vocabulary from the document '
+                                                 'frequency store with new or regenerated files')
+    parser.add_argument('files', nargs='*', metavar='FILE[:COLUMN]',
+                        help='files to count (text column index, default 1); by default '
+                             'the embedding corpus files of create_embeddings.py')
+    parser.add_argument('--store', default=f'{VOCAB_DIR}doc_freq.json')
+    parser.add_argument('--min-df', type=int, default=3)
+    parser.add_argument('--rebuild', action='store_true',
+                        help='count every file from scratch into a new store')
+    args = parser.parse_args()
+
+    files = dict(EMBEDDING_FILES)
+    if args.files:
+        files = {f.rsplit(':', 1)[0]: int(f.rsplit(':', 1)[1]) if ':' in f else 1
+                 for f in args.files}
+    if args.rebuild or not os.path.isfile(args.store):
+        build_vocab(files, outfile='vocab.csv', mask_dates=True, min_df=args.min_df,
+                    store=args.store)
+    else:
+        update_vocab(files, store=args.store, min_df=args.min_df)
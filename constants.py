@@ -9,13 +9,39 @@ VAL_PROP = 0.05
 assert sum([TRAIN_PROP, TEST_PROP, VAL_PROP]) == 1.0,\
     "Train/Test/Val split proportions must sum to 1."
 
+#near-duplicate case reports (see dedup.py): 'group' keeps them in the same split,
+#'drop' keeps only the first of each group and None skips detection
+NEAR_DUPLICATES = 'group'
+NEAR_DUP_THRESHOLD = 0.8
+
+#label pruning (see label_stats.py): keep labels seen at least LABEL_MIN_COUNT times in
+#training, and at most the LABEL_TOP_K most frequent of them (None for no limit)
+LABEL_MIN_COUNT = 5
+LABEL_TOP_K = None
+
 #where you want to save any models you may train
 MODEL_DIR = '/path/to/repo/saved_models/'
 
 RAW_DIR = '/media/stack/Storage/Documents/datasets/VAERS/'
+DEVICE_DIR = '/home/stack/Documents/datasets/DEVICE/'
 DATA_DIR = './vaersdata/'
 VOCAB_DIR = './vocab/'
 LABEL_DIR = './labels/'
 SOURCE_DATASET = 'w266_full_data.csv'
 TRAINING_DATA = 'train.csv'
-SUPPLEMENTAL_DATA = 'supplement_data.txt'
\ No newline at end of file
+#split of every report assigned so far, so reports keep their split across releases
+SPLIT_ASSIGNMENTS = 'split_assignments.csv'
+#also write each split as a directory of typed numpy columns (see datafuncs.write_columnar)
+WRITE_COLUMNAR = True
+SUPPLEMENTAL_DATA = 'supplement_data.txt'
+#files the embeddings and vocab are built from - key is the file path, value the
+#index of its text column. Configure and update this to add additional files
+EMBEDDING_FILES = {
+        f'{DATA_DIR}train_raw.csv': 1, #Training data
+        f'{DATA_DIR}device_data.csv': 1,
+        f'{DATA_DIR}wiki_data.csv': 1
+        }
+#per stage timing/memory run reports of the build scripts (see instrument.py), with a
+#cProfile dump of every stage when PROFILE_STAGES is set (or the PROFILE_STAGES env var)
+RUN_REPORT_DIR = f'{DATA_DIR}run_reports/'
+PROFILE_STAGES = False
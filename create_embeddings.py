@@ -1,80 +1,72 @@
 from collections import defaultdict
-import csv
 import gensim
 import pandas as pd
 import extract_wvs
 import word_embeddings
 import buildVocab
 from constants import *
+from instrument import RunReport
 
+if __name__ == "__main__":
+    report = RunReport('create_embeddings')
 
-#Create file dictionary - Configure and update this to add additional files to embeddings
-#Key - full file path, value - index of text column
-files = {
-        f'{DATA_DIR}train_raw.csv': 1, #Training data
-        f'{DATA_DIR}device_data.csv': 1,
-        f'{DATA_DIR}wiki_data.csv': 1
-        }
-embedding_name = 'train_device_wiki'
 
-#Train w2v embeddings (note: can be skipped if model already trained)
-print('Begin training embeddings...')
-w2v_file = word_embeddings.word_embeddings(embedding_name, files, 100, 3, 5)
-model = gensim.models.Word2Vec.load(w2v_file)
+    #Create file dictionary - configure EMBEDDING_FILES in constants.py to add additional files to embeddings
+    #Key - full file path, value - index of text column
+    files = dict(EMBEDDING_FILES)
+    embedding_name = 'train_device_wiki'
 
-#Extract word vectors
-wv = model.wv
-del(model)
+    #Train w2v embeddings (note: can be skipped if model already trained)
+    print('Begin training embeddings...')
+    with report.stage('word2vec') as stage:
+        w2v_file = word_embeddings.word_embeddings(embedding_name, files, 100, 3, 5)
+        model = gensim.models.Word2Vec.load(w2v_file)
+        stage.count(model.corpus_count)
 
-#Create Vocabulary
-print('Create vocabulary..')
-ind2w = defaultdict(str)
+    #Extract word vectors
+    wv = model.wv
+    del(model)
 
-vocab, vz = buildVocab.build_vocab(
-    filedict=files,
-    outfile='vocab.csv', 
-    mask_dates=True)
+    #Create Vocabulary
+    print('Create vocabulary..')
+    ind2w = defaultdict(str)
 
-# Index to word dictionary
-ind2w = {i+1:w for i,w in enumerate(sorted(vocab))}
-# Flip it - word to index
-w2ind = {w:i for i,w in ind2w.items()}
+    with report.stage('vocab') as stage:
+        vocab, vz = buildVocab.build_vocab(
+            filedict=files,
+            outfile='vocab.csv', 
+            mask_dates=True,
+            store=f'{VOCAB_DIR}doc_freq.json')
+        stage.count(len(vocab))
 
-# Build the embedding lookup matrix
-print('Build embedding matrix lookup...')
-W, words = extract_wvs.build_matrix(ind2w, wv)
+    # Index to word dictionary and its flip - word to index
+    vocab = buildVocab.Vocab(vocab.keys())
+    ind2w = {i: w for w, i in vocab.w2ind.items()}
 
-#Write out embeddings
-print('Write out embedding matrix...')
-with open(f'{DATA_DIR}{embedding_name}'+'.embed', 'w') as f:
-    for i in range(len(words)):
-        line = [words[i]]
-        line.extend([str(d) for d in W[i]])
-        f.write(" ".join(line) + "\n")
+    # Build the embedding lookup matrix
+    print('Build embedding matrix lookup...')
+    with report.stage('matrix_export') as stage:
+        W, words = extract_wvs.build_matrix(ind2w, wv)
 
-# Move on to the description vectors
-print('Write description vectors with vocab')
+        #Write out embeddings (binary, words alongside in .words)
+        print('Write out embedding matrix...')
+        extract_wvs.save_embeddings(W, words, f'{DATA_DIR}{embedding_name}.npy')
+        stage.count(len(words))
 
-# Read in the supplemental data
-sup_data = pd.read_csv(f'{DATA_DIR}{SUPPLEMENTAL_DATA}', sep="\t")
+    # Move on to the description vectors
+    print('Write description vectors with vocab')
 
-# Tokenize
-tokenizer = buildVocab.CustAnalyzer(mask_dates=True)
-sup_data['tokens'] = sup_data.desc.apply(lambda x: tokenizer(x))
-# Get index of each token
-sup_data['inds'] = sup_data.tokens.apply(
-    lambda tok: [w2ind[t] if t in w2ind.keys() else len(w2ind) + 1 for t in tok]
-)
-# Build the line to be used in the output file
-sup_data['out_line'] = sup_data.apply(
-    lambda x: [x.label] + x.inds,
-    axis=1
-)
-# Subset
-sup_data = sup_data[['out_line']]
+    # Read in the supplemental data
+    sup_data = pd.read_csv(f'{DATA_DIR}{SUPPLEMENTAL_DATA}', sep="\t")
 
-# Write out the description vectors
-with open(f'{DATA_DIR}description_vectors.vocab', 'w+') as f:
-    w = csv.writer(f, delimiter=' ')
-    w.writerow(['CODE', 'VECTOR'])
-    sup_data.out_line.apply(lambda x: w.writerow(x))
+    with report.stage('description_vectors') as stage:
+        # Tokenize
+        tokenizer = buildVocab.CustAnalyzer(mask_dates=True)
+        tokens = list(tokenizer.batch(sup_data.desc))
+        # Get index of each token
+        ids, offsets = vocab.encode(tokens)
+
+        # Write out the description vectors
+        buildVocab.write_description_vectors(
+            f'{DATA_DIR}description_vectors.vocab', sup_data.label, ids, offsets)
+        stage.count(len(tokens))
@@ -1,11 +1,355 @@
+import hashlib
+import inspect
+import os
+import shutil
+import tempfile
+import zipfile
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
 import ast
 
-def read_data(datafile):
-    ''' Helper function to properly read in the CSV post processed data'''
+from constants import *
+
+# Coded symptom columns of the VAERSSYMPTOMS data
+SYMPTOM_COLUMNS = [f'SYMPTOM{i}' for i in range(1, 6)]
+
+# read_csv arguments that skip malformed lines. pandas 1.3 replaced
+# error_bad_lines with on_bad_lines and pandas 2 removed it
+SKIP_BAD_LINES = {'on_bad_lines': 'skip'} \
+    if 'on_bad_lines' in inspect.signature(pd.read_csv).parameters \
+    else {'error_bad_lines': False}
+
+# Split names, in the order of TRAIN_PROP, TEST_PROP and VAL_PROP
+SPLITS = ('train', 'test', 'dev')
+
+# Fixed column layout of a merged archive so chunks can be stacked as text
+ARCHIVE_COLUMNS = ['VAERS_ID', 'SYMPTOM_TEXT'] + \
+    [f'{var}{i}' for i in range(1, 6) for var in ('SYMPTOM', 'SYMPTOMVERSION')] + \
+    ['SOURCE']
+
+def read_data(datafile, columns=None):
+    ''' Helper function to properly read in the CSV post processed data.
+        A directory written by write_columnar reads back with the same
+        types (LABELS as ';' joined strings, empty values as NaN), keeping
+        only the requested columns. Use load_columnar for its raw arrays
+    '''
+    if os.path.isdir(datafile):
+        return read_columnar(datafile, columns)
+
     # Read
-    df = pd.read_csv(datafile)
+    df = pd.read_csv(datafile, usecols=columns)
     # Convert strings to lists
-    df['SYMPTOMS'] = df['SYMPTOMS'].apply(lambda x: ast.literal_eval(x))
-    df['VERSIONS'] = df['VERSIONS'].apply(lambda x: ast.literal_eval(x))
-    return df
\ No newline at end of file
+    for column in ('SYMPTOMS', 'VERSIONS'):
+        if column in df:
+            df[column] = df[column].apply(lambda x: ast.literal_eval(x))
+    return df
+
+def write_columnar(df, outdir, list_columns=('LABELS',), sep=';'):
+    ''' Write a split out as a directory of typed NumPy columns.
+            - numeric columns are stored as a single .npy array
+            - text columns as a utf-8 byte blob plus row offsets
+            - list columns (sep-joined strings) as integer ids into
+              a vocabulary of their values plus row offsets
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    # Keep the column order for loading
+    with open(os.path.join(outdir, 'columns.txt'), 'w') as f:
+        f.write('\n'.join(df.columns))
+
+    for column in df.columns:
+        values = df[column]
+        path = os.path.join(outdir, column)
+
+        if column in list_columns:
+            lists = [x.split(sep) if isinstance(x, str) and x else []
+                     for x in values]
+            vocab = sorted(set(v for x in lists for v in x))
+            index = {v: i for i, v in enumerate(vocab)}
+            ids = np.fromiter((index[v] for x in lists for v in x), dtype=np.int32)
+            np.save(f'{path}.ids.npy', ids)
+            np.save(f'{path}.offsets.npy', _offsets(len(x) for x in lists))
+            with open(f'{path}.vocab.txt', 'w') as f:
+                f.write('\n'.join(vocab))
+
+        elif pd.api.types.is_numeric_dtype(values):
+            np.save(f'{path}.npy', values.values)
+
+        else:
+            encoded = [x.encode('utf-8') if isinstance(x, str) else b''
+                       for x in values]
+            blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            np.save(f'{path}.bytes.npy', blob)
+            np.save(f'{path}.offsets.npy', _offsets(len(x) for x in encoded))
+
+def _offsets(sizes):
+    ''' Row offsets (n + 1 entries) from an iterable of row sizes '''
+    return np.concatenate([[0], np.cumsum(np.fromiter(sizes, dtype=np.int64))])
+
+def load_columnar(datadir, columns=None, mmap_mode='r'):
+    ''' Load the raw arrays of a directory written by write_columnar.
+        Returns a dict of column name to a numpy array (numeric), a tuple
+        (bytes, offsets) (text) or a tuple (ids, offsets, vocab) (lists)
+    '''
+    files = os.listdir(datadir)
+    if columns is None:
+        with open(os.path.join(datadir, 'columns.txt')) as f:
+            columns = f.read().split('\n')
+
+    out = {}
+    for column in columns:
+        path = os.path.join(datadir, column)
+        if f'{column}.vocab.txt' in files:
+            with open(f'{path}.vocab.txt') as f:
+                vocab = f.read().split('\n')
+            out[column] = (np.load(f'{path}.ids.npy', mmap_mode=mmap_mode),
+                           np.load(f'{path}.offsets.npy', mmap_mode=mmap_mode),
+                           vocab)
+        elif f'{column}.bytes.npy' in files:
+            out[column] = (np.load(f'{path}.bytes.npy', mmap_mode=mmap_mode),
+                           np.load(f'{path}.offsets.npy', mmap_mode=mmap_mode))
+        elif f'{column}.npy' in files:
+            out[column] = np.load(f'{path}.npy', mmap_mode=mmap_mode)
+        else:
+            raise KeyError(f'No column {column} in {datadir}')
+    return out
+
+def read_columnar(datadir, columns=None):
+    ''' Read a directory written by write_columnar into a DataFrame with
+        the same types read_data gives for the CSV - text as strings,
+        list columns joined back into sep joined strings and empty values
+        as NaN. Each column is decoded in one pass, never row by row
+    '''
+    data = {}
+    for column, arrays in load_columnar(datadir, columns).items():
+        if isinstance(arrays, np.ndarray):
+            data[column] = np.asarray(arrays)
+            continue
+        if len(arrays) == 3:
+            rows = join_rows(*arrays)
+        else:
+            rows = decode_rows(*arrays)
+        # Empty values read back from a CSV as NaN
+        rows = np.array(rows, dtype=object)
+        rows[rows == ''] = np.nan
+        data[column] = rows
+    return pd.DataFrame(data, columns=list(data))
+
+def decode_rows(blob, offsets):
+    ''' Strings of a text column. A NUL is placed at every row boundary
+        so the blob decodes and splits back into rows in one call each '''
+    offsets = np.asarray(offsets)
+    if len(offsets) < 2:
+        return []
+    marked = np.insert(np.asarray(blob), offsets[1:-1], 0)
+    return marked.tobytes().decode('utf-8').split('\x00')
+
+def join_rows(ids, offsets, vocab, sep=';'):
+    ''' sep joined strings of a list column, built as one string with a
+        NUL after every row and split back into rows '''
+    ids, offsets = np.asarray(ids), np.asarray(offsets)
+    if len(offsets) < 2:
+        return []
+    values = np.array(vocab, dtype=object)[ids]
+    lengths = np.diff(offsets)
+    # Each value is followed by sep, or by NUL if it ends its row
+    seps = np.full(len(ids), sep, dtype=object)
+    seps[offsets[1:][lengths > 0] - 1] = '\x00'
+    parts = np.empty(2 * len(ids), dtype=object)
+    parts[0::2] = values
+    parts[1::2] = seps
+    # Empty rows are just their NUL
+    parts = np.insert(parts, 2 * offsets[:-1][lengths == 0], '\x00')
+    return ''.join(parts.tolist()).split('\x00')[:-1]
+
+# Whitespace bytes bytes.split() splits on
+_WHITESPACE = np.frombuffer(b' \t\n\r\x0b\x0c', dtype=np.uint8)
+
+def split_tokens(blob, offsets):
+    ''' Whitespace separated tokens of every row of a text column, for
+        encoding a columnar split without materializing its rows.
+        Returns (tokens, token offsets) in the layout of Vocab.encode
+    '''
+    blob, offsets = np.asarray(blob), np.asarray(offsets)
+    # A space at every row boundary so no token spans two rows
+    spaced = np.insert(blob, offsets[1:-1], ord(' ')).tobytes()
+    tokens = b' '.join(spaced.split()).decode('utf-8').split(' ') if spaced.strip() else []
+
+    # A token starts at a non-space byte after a space or a row start
+    space = np.isin(blob, _WHITESPACE)
+    after_space = np.concatenate([[True], space[:-1]])
+    after_space[offsets[:-1][offsets[:-1] < len(blob)]] = True
+    seen = np.concatenate([[0], np.cumsum(~space & after_space)])
+    return tokens, _offsets(seen[offsets[1:]] - seen[offsets[:-1]])
+
+def file_sha256(path):
+    ''' sha256 hex digest of a file's contents, read in blocks '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def find_member(zf, suffix):
+    ''' Find the archive member ending with suffix (case insensitive) '''
+    for name in zf.namelist():
+        if name.upper().endswith(suffix.upper()):
+            return name
+    raise KeyError(f'No member ending with {suffix} in {zf.filename}')
+
+def read_archive(archive):
+    ''' Read the verbatim and coded data straight out of a yearly
+        VAERS archive, without extracting it, and merge the two.
+        Returns pandas.DataFrame with ARCHIVE_COLUMNS
+    '''
+    # Pull out the archive name
+    sample = os.path.basename(archive)[:-13]
+
+    with zipfile.ZipFile(archive) as zf:
+        # Read in the verbatim data
+        with zf.open(find_member(zf, 'VAERSDATA.csv')) as f:
+            verbatim = pd.read_csv(f, encoding='latin1', **SKIP_BAD_LINES,
+                                   usecols=['VAERS_ID', 'SYMPTOM_TEXT'])
+        # Read in the coded data
+        with zf.open(find_member(zf, 'VAERSSYMPTOMS.csv')) as f:
+            coded = pd.read_csv(f, encoding='latin1', **SKIP_BAD_LINES)
+
+    # Merge the two
+    df = verbatim.merge(coded, how='left', on='VAERS_ID')
+
+    # Assign sample for tracing
+    df['SOURCE'] = sample
+
+    return df.reindex(columns=ARCHIVE_COLUMNS)
+
+def _write_archive_chunk(args):
+    ''' Pool worker - merge one archive and write it out as its own chunk '''
+    archive, chunk_dir = args
+    df = read_archive(archive)
+    chunk = os.path.join(chunk_dir, os.path.basename(archive) + '.csv')
+    df.to_csv(chunk, index=False)
+    return archive, chunk, df.shape[0]
+
+def assemble_archives(raw_dir, outfile, n_jobs=None):
+    ''' Merge every VAERS archive in raw_dir into outfile. Archives are
+        processed independently in a process pool, each written out as
+        its own chunk, and the chunks are stacked once at the end so only
+        one archive per worker is ever held in memory.
+        Returns the total number of rows written
+    '''
+    archives = sorted(os.path.join(raw_dir, a) for a in os.listdir(raw_dir)
+                      if a.lower().endswith('.zip'))
+    chunk_dir = tempfile.mkdtemp(dir=os.path.dirname(outfile) or '.')
+    total = 0
+
+    try:
+        with Pool(n_jobs) as pool:
+            # imap keeps the archive order so the output is deterministic
+            chunks = list(pool.imap(_write_archive_chunk,
+                                    [(a, chunk_dir) for a in archives]))
+        # Stack the chunks, keeping only the first header
+        with open(outfile, 'wb') as out:
+            for i, (archive, chunk, rows) in enumerate(chunks):
+                print(f'Processed {os.path.basename(archive)} ({rows} rows)')
+                with open(chunk, 'rb') as f:
+                    if i > 0:
+                        f.readline()
+                    shutil.copyfileobj(f, out)
+                total += rows
+    finally:
+        shutil.rmtree(chunk_dir)
+
+    return total
+
+def aggregate_symptoms(compiled):
+    ''' Collect the SYMPTOM1..5 columns of every row into a single label
+        list per VAERS_ID, keeping row then column order. Works on the
+        stacked columns in one pass rather than row by row.
+        Returns pandas.DataFrame with VAERS_ID, SYMPTOMS and LABELS
+    '''
+    compiled = compiled[pd.notna(compiled.VAERS_ID)]
+    ids = compiled.VAERS_ID.values
+    symptoms = compiled[SYMPTOM_COLUMNS].values
+
+    # Flatten row-major and drop the empty slots
+    present = pd.notna(symptoms)
+    flat_ids = np.broadcast_to(ids[:, None], symptoms.shape)[present]
+    flat_labels = symptoms[present]
+
+    # Stable sort so labels keep their original order within a report
+    order = np.argsort(flat_ids, kind='mergesort')
+    flat_ids = flat_ids[order]
+    flat_labels = flat_labels[order]
+
+    # Every report is kept, even those without a coded symptom
+    report_ids = np.unique(ids)
+    starts = np.searchsorted(flat_ids, report_ids)
+    groups = [g.tolist() for g in np.split(flat_labels, starts[1:])]
+
+    return pd.DataFrame({
+        'VAERS_ID': report_ids,
+        'SYMPTOMS': groups,
+        'LABELS': [';'.join(g) for g in groups]
+    })
+
+def _mix64(x):
+    ''' splitmix64 finalizer - a stable, well spread hash of uint64s '''
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def assign_splits(keys, props=(TRAIN_PROP, TEST_PROP, VAL_PROP), seed=1234):
+    ''' Split of every key (e.g. VAERS_ID) from a stable hash of the key
+        alone, so a report keeps its split as new releases arrive and
+        chunks can be assigned independently, in any order or process.
+        Returns an array of indices into SPLITS
+    '''
+    keys = np.asarray(keys).astype(np.int64).astype(np.uint64)
+    salt = np.uint64((seed * 0x9e3779b97f4a7c15) & 0xffffffffffffffff)
+    hashed = _mix64(keys + salt)
+    # Top 53 bits as a uniform float in [0, 1)
+    uniform = (hashed >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+    return np.searchsorted(np.cumsum(props)[:-1], uniform, side='right')
+
+def group_splits(ids, groups=None, assigned=None):
+    ''' Split of every report as indices into SPLITS. Reports in assigned
+        (a Series of split indices by VAERS_ID from earlier releases, see
+        read_assignments) keep their split. A new report joins the split
+        of the lowest assigned VAERS_ID of its near-duplicate group, and
+        the reports of a new group all hash its lowest VAERS_ID.
+        A new follow up that bridges two groups already in different
+        splits joins one of them - the other group stays where it is, so
+        the merged group spans splits rather than moving old reports
+    '''
+    ids = pd.Series(np.asarray(ids))
+    groups = pd.Series(np.arange(len(ids)) if groups is None else np.asarray(groups))
+    split = pd.Series(assign_splits(ids.groupby(groups).transform('min').values))
+    if assigned is None or len(assigned) == 0:
+        return split.values
+
+    old = ids.map(assigned)
+    known = old.notna()
+    # Split of the lowest assigned report of every group holding one
+    first = ids[known].groupby(groups[known]).idxmin()
+    inherited = groups.map(pd.Series(old[first.values].values, index=first.index))
+    split = inherited.where(inherited.notna(), split)
+    split[known] = old[known]
+    return split.values.astype(np.int64)
+
+def read_assignments(path):
+    ''' Split indices by VAERS_ID written by write_assignments, or None
+        before the first release '''
+    if not os.path.isfile(path):
+        return None
+    df = pd.read_csv(path)
+    return pd.Series(df.SPLIT.map({s: i for i, s in enumerate(SPLITS)}).values,
+                     index=df.VAERS_ID.values)
+
+def write_assignments(path, ids, split, assigned=None):
+    ''' Save the split of every report, keeping earlier assignments of
+        reports missing from this release '''
+    current = pd.Series(np.asarray(split), index=np.asarray(ids))
+    if assigned is not None:
+        current = pd.concat([assigned[~assigned.index.isin(current.index)], current])
+    pd.DataFrame({'VAERS_ID': current.index, 'SPLIT': np.array(SPLITS)[current.values]})\
+        .to_csv(path, index=False)
@@ -0,0 +1,118 @@
+'''
+dedup.py
+    Near-duplicate detection for case report narratives using MinHash
+    signatures over token shingles and locality sensitive hashing, so
+    only reports sharing a band of their signature are ever compared
+'''
+import zlib
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from constants import *
+
+def _token_hashes(docs):
+    ''' Deterministic 32 bit hash of every token, computed once per
+        distinct token. Returns (hashes, offsets) '''
+    cache = {}
+    lengths = []
+    hashes = []
+    for doc in docs:
+        tokens = doc.split() if isinstance(doc, str) else []
+        for t in tokens:
+            h = cache.get(t)
+            if h is None:
+                h = cache[t] = zlib.crc32(t.encode('utf-8'))
+            hashes.append(h)
+        lengths.append(len(tokens))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.array(hashes, dtype=np.uint64), offsets
+
+def shingles(docs, k=3):
+    ''' Hashes of the k-token shingles of each document. Documents with
+        fewer than k tokens are a single shingle of all their tokens.
+        Returns (shingle hashes, offsets)
+    '''
+    hashes, offsets = _token_hashes(docs)
+    lengths = np.diff(offsets)
+    counts = np.where(lengths >= k, lengths - k + 1, np.minimum(lengths, 1))
+
+    # Start token and width of every shingle
+    shingle_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=shingle_offsets[1:])
+    doc_of = np.repeat(np.arange(len(counts)), counts)
+    starts = offsets[doc_of] + (np.arange(shingle_offsets[-1]) - shingle_offsets[doc_of])
+    widths = np.minimum(lengths[doc_of], k)
+
+    # Polynomial combination of the token hashes, wrapping at 64 bits
+    out = np.zeros(len(starts), dtype=np.uint64)
+    for j in range(k):
+        present = widths > j
+        out[present] = out[present] * np.uint64(1000003) + hashes[starts[present] + j]
+    return out, shingle_offsets
+
+def minhash_signatures(docs, num_perm=128, k=3, seed=1234, batch_size=1 << 16):
+    ''' MinHash signature of every document's shingle set using
+        multiply-shift hashing. Documents without tokens get an all-max
+        signature and are never grouped with anything.
+        Returns numpy.ndarray of shape (documents, num_perm), uint32
+    '''
+    rng = np.random.RandomState(seed)
+    a = (rng.randint(0, 1 << 32, num_perm, dtype=np.uint64) << np.uint64(32)) | \
+        rng.randint(0, 1 << 32, num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.randint(0, 1 << 32, num_perm, dtype=np.uint64)
+
+    values, offsets = shingles(docs, k)
+    n = len(offsets) - 1
+    signatures = np.full((n, num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    nonempty = np.flatnonzero(np.diff(offsets) > 0)
+
+    # Work through batches of whole documents, bounded by shingle count
+    ends = offsets[nonempty + 1]
+    start = 0
+    while start < len(nonempty):
+        end = start + 1
+        limit = offsets[nonempty[start]] + batch_size
+        end = max(end, int(np.searchsorted(ends, limit, side='right')))
+        docs_ = nonempty[start:end]
+        lo, hi = offsets[docs_[0]], offsets[docs_[-1] + 1]
+        hashed = ((a[:, None] * values[None, lo:hi] + b[:, None]) >> np.uint64(32))
+        signatures[docs_] = np.minimum.reduceat(hashed, offsets[docs_] - lo, axis=1).T
+        start = end
+    return signatures
+
+def near_duplicate_groups(signatures, bands=16, threshold=0.8):
+    ''' Group documents whose signatures agree on any whole band (LSH)
+        and whose estimated Jaccard similarity is at least threshold.
+        Groups are the connected components of those pairs.
+        Returns an array giving every document its group number
+    '''
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    empty = (signatures == np.iinfo(np.uint32).max).all(axis=1)
+    src, dst = [], []
+
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = block.view(np.dtype((np.void, block.dtype.itemsize * rows))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        # Pair each document with the first document of its bucket
+        rep = first[inverse.ravel()]
+        candidate = np.flatnonzero((rep != np.arange(n)) & ~empty)
+        if len(candidate) == 0:
+            continue
+        agree = (signatures[candidate] == signatures[rep[candidate]]).mean(axis=1)
+        keep = candidate[agree >= threshold]
+        src.append(keep)
+        dst.append(rep[keep])
+
+    src = np.concatenate(src) if src else np.array([], dtype=np.int64)
+    dst = np.concatenate(dst) if dst else np.array([], dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+def find_near_duplicates(texts, num_perm=128, bands=16, threshold=0.8, k=3, seed=1234):
+    ''' Near-duplicate group of every space joined token string '''
+    signatures = minhash_signatures(texts, num_perm=num_perm, k=k, seed=seed)
+    return near_duplicate_groups(signatures, bands=bands, threshold=threshold)
@@ -0,0 +1,125 @@
+'''
+encode_data.py
+    Encode the train/test/dev splits as flat token id arrays with
+    document offsets and a sparse multi-hot label matrix, all of which
+    can be memory mapped when loading
+'''
+import os
+import json
+import numpy as np
+from scipy import sparse
+
+from constants import *
+from buildVocab import Vocab
+from datafuncs import load_columnar, read_data, split_tokens
+
+def read_labels(label_file=f'{LABEL_DIR}labels.csv'):
+    ''' Label to column dictionary in labels.csv order '''
+    with open(label_file, 'r') as f:
+        labels = [x.replace('\n', '') for x in f.readlines()]
+    return {l: i for i, l in enumerate(labels) if l != ''}
+
+def encode_labels(labels, l2ind, sep=';'):
+    ''' Build the multi-hot label matrix from label lists or sep joined
+        label strings. Labels missing from l2ind are dropped.
+        Returns scipy.sparse.csr_matrix of shape (documents, len(l2ind))
+    '''
+    indices = []
+    indptr = [0]
+    dropped = 0
+    for row in labels:
+        if isinstance(row, str):
+            row = row.split(sep) if row else []
+        elif not isinstance(row, list):
+            row = []
+        cols = set(l2ind[l] for l in row if l in l2ind)
+        dropped += sum(1 for l in row if l not in l2ind)
+        indices.extend(sorted(cols))
+        indptr.append(len(indices))
+    if dropped:
+        print(f'Dropped {dropped} labels missing from the label set')
+
+    indices = np.array(indices, dtype=np.int32)
+    data = np.ones(len(indices), dtype=np.int8)
+    return sparse.csr_matrix((data, indices, np.array(indptr, dtype=np.int64)),
+                             shape=(len(indptr) - 1, len(l2ind)))
+
+def encode_label_ids(ids, offsets, vocab, l2ind):
+    ''' encode_labels for a list column as stored by write_columnar -
+        label ids into vocab with row offsets - mapped straight to
+        columns of the label matrix '''
+    ids, offsets = np.asarray(ids), np.asarray(offsets)
+    columns = np.array([l2ind.get(l, -1) for l in vocab], dtype=np.int64)[ids]
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    known = columns >= 0
+    if not known.all():
+        print(f'Dropped {int((~known).sum())} labels missing from the label set')
+
+    # Summing duplicates leaves each label once per row, in column order
+    label_matrix = sparse.csr_matrix(
+        (np.ones(int(known.sum()), dtype=np.int8), (rows[known], columns[known])),
+        shape=(len(offsets) - 1, len(l2ind)))
+    label_matrix.sum_duplicates()
+    label_matrix.data[:] = 1
+    return label_matrix
+
+def write_encoded(outdir, ids, tokens, offsets, label_matrix):
+    ''' Write an encoded split out as .npy arrays '''
+    os.makedirs(outdir, exist_ok=True)
+    np.save(os.path.join(outdir, 'ids.npy'), np.asarray(ids))
+    np.save(os.path.join(outdir, 'tokens.npy'), tokens)
+    np.save(os.path.join(outdir, 'offsets.npy'), offsets)
+    np.save(os.path.join(outdir, 'label_indptr.npy'), label_matrix.indptr)
+    np.save(os.path.join(outdir, 'label_indices.npy'), label_matrix.indices)
+    with open(os.path.join(outdir, 'meta.json'), 'w') as f:
+        json.dump({'documents': label_matrix.shape[0],
+                   'labels': label_matrix.shape[1],
+                   'tokens': int(tokens.shape[0])}, f)
+
+def load_encoded(outdir, mmap_mode='r'):
+    ''' Load an encoded split. Token arrays are memory mapped so
+        batches are zero-copy slices.
+        Returns (ids, tokens, offsets, label_matrix)
+    '''
+    with open(os.path.join(outdir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    load = lambda name: np.load(os.path.join(outdir, name), mmap_mode=mmap_mode)
+    # Pruned label sets (see label_stats.py) share the full split's tokens
+    token_dir = os.path.join(outdir, meta.get('tokens_from', '.'))
+    load_tokens = lambda name: np.load(os.path.join(token_dir, name), mmap_mode=mmap_mode)
+
+    indices = load('label_indices.npy')
+    label_matrix = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int8), indices, load('label_indptr.npy')),
+        shape=(meta['documents'], meta['labels']))
+    return load_tokens('ids.npy'), load_tokens('tokens.npy'), load_tokens('offsets.npy'), \
+        label_matrix
+
+def encode_split(datafile, outdir, vocab, l2ind):
+    ''' Encode one split file (CSV or columnar directory) '''
+    if os.path.isdir(datafile):
+        # Straight from the stored arrays, without building the rows
+        columns = load_columnar(datafile, ['VAERS_ID', 'TEXT', 'LABELS'])
+        tokens, offsets = vocab.encode_tokens(*split_tokens(*columns['TEXT']))
+        label_matrix = encode_label_ids(*columns['LABELS'], l2ind)
+        write_encoded(outdir, np.asarray(columns['VAERS_ID']), tokens, offsets, label_matrix)
+        return len(offsets) - 1
+
+    df = read_data(datafile, columns=['VAERS_ID', 'TEXT', 'LABELS'])
+    tokens, offsets = vocab.encode(df.TEXT)
+    label_matrix = encode_labels(df.LABELS, l2ind)
+    write_encoded(outdir, df.VAERS_ID.values, tokens, offsets, label_matrix)
+    return df.shape[0]
+
+if __name__ == "__main__":
+    vocab = Vocab.from_file()
+    l2ind = read_labels()
+    print(f'Encoding with {len(vocab)} words and {len(l2ind)} labels')
+
+    for split in ('train', 'test', 'dev'):
+        # Prefer the columnar split since it loads without parsing
+        datafile = f'{DATA_DIR}{split}/'
+        if not os.path.isdir(datafile):
+            datafile = f'{DATA_DIR}{split}.csv'
+        rows = encode_split(datafile, f'{DATA_DIR}{split}_encoded/', vocab, l2ind)
+        print(f'Encoded {rows} {split} records')
@@ -4,7 +4,6 @@
 import csv
 import os
 import gensim.models
-from tqdm import tqdm
 
 from constants import *
 #import datasets
@@ -33,43 +32,232 @@ def gensim_to_embeddings(wv_file, vocab_file, Y, outfile=None):
     #smash that save button
     save_embeddings(W, words, outfile)
 
-def build_matrix(ind2w, wv):
+def word_index(wv):
     """
-        Go through vocab in order. Find vocab word in wv.index2word, then call wv.word_vec(wv.index2word[i]).
-        Put results into one big matrix.
+        Word to row dictionary of the gensim keyed vectors, for gensim 3 (vocab) or 4 (key_to_index)
+    """
+    if hasattr(wv, 'key_to_index'):
+        return wv.key_to_index
+    return {w: v.index for w, v in wv.vocab.items()}
+
+def build_matrix(ind2w, wv, oov='zero', seed=None, dtype=None):
+    """
+        Go through vocab in order and gather every word's row of the keyed vectors with a single fancy index.
         Note: ind2w starts at 1 (saving 0 for the pad character), but gensim word vectors starts at 0
+        oov: what to do with vocab words missing from wv - 'zero' leaves their row at zero, 'random' fills
+            it with a gaussian vector (seeded with seed) and 'error' raises a KeyError
+        dtype: of the matrix, by default that of the word vectors (float32 for gensim) so nothing is widened
     """
-    W = np.zeros((len(ind2w)+1, len(wv.word_vec(wv.index2word[0])) ))
-    words = [PAD_CHAR]
-    W[0][:] = np.zeros(len(wv.word_vec(wv.index2word[0])))
-    for idx, word in tqdm(ind2w.items()):
-        if idx >= W.shape[0]:
-            break    
-        W[idx][:] = wv.word_vec(word)
-        words.append(word)
+    vectors = wv.vectors if hasattr(wv, 'vectors') else wv.syn0
+    index = word_index(wv)
+
+    words = [PAD_CHAR] + [ind2w[i] for i in range(1, len(ind2w) + 1)]
+    rows = np.array([index.get(w, -1) for w in words[1:]], dtype=np.int64)
+    found = rows >= 0
+
+    W = np.zeros((len(words), vectors.shape[1]), dtype=dtype or vectors.dtype)
+    W[1:][found] = vectors[rows[found]]
+
+    missing = int((~found).sum())
+    if missing:
+        if oov == 'error':
+            raise KeyError("%d vocab words missing from the word vectors, e.g. %s"
+                           % (missing, words[1 + np.flatnonzero(~found)[0]]))
+        elif oov == 'random':
+            rng = np.random.RandomState(seed)
+            W[1:][~found] = rng.randn(missing, vectors.shape[1])
+        print("%d vocab words missing from the word vectors (%s)" % (missing, oov))
     return W, words
 
-def save_embeddings(W, words, outfile):
-    with open(outfile, 'w') as o:
-        #pad token already included
-        for i in range(len(words)):
-            line = [words[i]]
-            line.extend([str(d) for d in W[i]])
-            o.write(" ".join(line) + "\n")
-
-def load_embeddings(embed_file):
-    #also normalizes the embeddings
-    W = []
-    with open(embed_file) as ef:
-        for line in ef:
-            line = line.rstrip().split()
-            vec = np.array(line[1:]).astype(np.float)
-            vec = vec / float(np.linalg.norm(vec) + 1e-6)
-            W.append(vec)
-        #UNK embedding, gaussian randomly initialized 
-        print("adding unk embedding")
-        vec = np.random.randn(len(W[-1]))
-        vec = vec / float(np.linalg.norm(vec) + 1e-6)
-        W.append(vec)
-    W = np.array(W)
-    return W
\ No newline at end of file
+def words_file(outfile):
+    return os.path.splitext(outfile)[0] + '.words'
+
+def scales_file(outfile):
+    return os.path.splitext(outfile)[0] + '.scales.npy'
+
+#storage precisions of .npy embedding files
+PRECISIONS = ('float64', 'float32', 'float16', 'int8')
+
+def quantize_rows(W):
+    """
+        Symmetric int8 quantization with one float32 scale per row, so every row keeps its own range.
+        Returns (int8 matrix, scales) where row i is approximately Q[i] * scales[i]
+    """
+    scales = (np.abs(W).max(axis=1) / 127.0).astype(np.float32)
+    Q = np.empty(W.shape, dtype=np.int8)
+    #all zero rows (e.g. the pad row) quantize to zero
+    np.rint(W / np.where(scales > 0, scales, 1)[:, None], out=Q, casting='unsafe')
+    return Q, scales
+
+def dequantize_rows(Q, scales, dtype=np.float32):
+    return Q.astype(dtype) * scales.astype(dtype)[:, None]
+
+def to_precision(W, precision):
+    """
+        W stored at precision, one of PRECISIONS. int8 gives (int8 matrix, scales)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be one of %s, not %r" % (PRECISIONS, precision))
+    if precision == 'int8':
+        return quantize_rows(W)
+    return np.asarray(W, dtype=precision)
+
+def save_embeddings(W, words, outfile, precision=None):
+    """
+        Write the embedding matrix in the format given by the extension of outfile:
+            .npy - the matrix as a numpy array, with the words one per line in a .words file alongside
+            .bin - word2vec binary format (float32)
+            anything else - text, one word and its vector per line
+        precision: for .npy, store the matrix as one of PRECISIONS instead of W's own dtype. int8 writes
+            per row scales to a .scales.npy file alongside
+    """
+    ext = os.path.splitext(outfile)[1]
+    if ext == '.npy':
+        if os.path.isfile(scales_file(outfile)):
+            os.remove(scales_file(outfile))
+        if precision == 'int8':
+            W, scales = quantize_rows(W)
+            np.save(scales_file(outfile), scales)
+        elif precision is not None:
+            W = to_precision(W, precision)
+        np.save(outfile, W)
+        with open(words_file(outfile), 'w') as o:
+            o.write("\n".join(words) + "\n")
+    elif ext == '.bin':
+        vectors = W.astype('<f4')
+        with open(outfile, 'wb') as o:
+            o.write(("%d %d\n" % W.shape).encode('utf-8'))
+            for word, vec in zip(words, vectors):
+                o.write(word.encode('utf-8') + b' ' + vec.tobytes() + b'\n')
+    else:
+        with open(outfile, 'w') as o:
+            #pad token already included
+            for word, vec in zip(words, W.tolist()):
+                o.write(word + " " + " ".join(map(str, vec)) + "\n")
+
+def read_embeddings(embed_file, mmap_mode='r'):
+    """
+        Read an embedding matrix written by save_embeddings, without normalizing.
+        .npy files are memory mapped (read-only by default) so processes share the page cache. int8 files
+        are dequantized to float32; use read_quantized to keep them as int8
+    """
+    ext = os.path.splitext(embed_file)[1]
+    if ext == '.npy':
+        if os.path.isfile(scales_file(embed_file)):
+            return dequantize_rows(*read_quantized(embed_file, mmap_mode))
+        return np.load(embed_file, mmap_mode=mmap_mode)
+    elif ext == '.bin':
+        with open(embed_file, 'rb') as ef:
+            n, dim = map(int, ef.readline().split())
+            W = np.empty((n, dim), dtype=np.float32)
+            for i in range(n):
+                #word, then dim float32 values
+                while True:
+                    c = ef.read(1)
+                    if c == b' ':
+                        break
+                    if c == b'':
+                        raise ValueError(f'{embed_file} is truncated at row {i} of {n}')
+                vec = ef.read(4 * dim)
+                if len(vec) < 4 * dim:
+                    raise ValueError(f'{embed_file} is truncated at row {i} of {n}')
+                W[i] = np.frombuffer(vec, dtype='<f4')
+                ef.read(1)
+        return W
+    else:
+        with open(embed_file) as ef:
+            return np.array([line.rstrip().split()[1:] for line in ef], dtype=np.float64)
+
+def read_quantized(embed_file, mmap_mode='r'):
+    """
+        The int8 matrix and per row scales of an int8 .npy file, memory mapped, for callers that can work
+        on Q[i] * scales[i] directly (e.g. scores = (Q @ query) * scales)
+    """
+    return np.load(embed_file, mmap_mode=mmap_mode), np.load(scales_file(embed_file))
+
+def load_embeddings(embed_file, dtype=np.float64, seed=1234, normalized=False):
+    """
+        Load the embedding matrix, L2 normalize every row in one pass and append a gaussian UNK row
+        (seeded with seed, fixed by default so every load gets the same UNK row). dtype sets the precision
+        of the returned matrix.
+        normalized: embed_file was written by save_normalized and already holds the normalized matrix
+            with its UNK row, so it is returned memory mapped as is
+    """
+    if normalized:
+        return read_embeddings(embed_file)
+
+    W = read_embeddings(embed_file)
+    out = np.empty((W.shape[0] + 1, W.shape[1]), dtype=dtype)
+    out[:-1] = W
+    out[:-1] /= (np.linalg.norm(out[:-1], axis=1, keepdims=True) + 1e-6)
+
+    #UNK embedding, gaussian randomly initialized
+    print("adding unk embedding")
+    vec = np.random.RandomState(seed).randn(W.shape[1])
+    out[-1] = vec / float(np.linalg.norm(vec) + 1e-6)
+    return out
+
+def save_normalized(embed_file, outfile, dtype=np.float32, seed=1234):
+    """
+        Normalize once and save the result (with its UNK row) as .npy, so training workers on a node can
+        load_embeddings(outfile, normalized=True) and share one page cached copy.
+        dtype: any of PRECISIONS, e.g. 'float16' or 'int8' to fit more embedding variants on one node
+    """
+    W = load_embeddings(embed_file, dtype=np.float32 if dtype == 'int8' else dtype, seed=seed)
+    if os.path.isfile(scales_file(outfile)):
+        os.remove(scales_file(outfile))
+    if dtype == 'int8':
+        W, scales = quantize_rows(W)
+        np.save(scales_file(outfile), scales)
+    np.save(outfile, W)
+    return outfile
+
+def cosine_error(W, W_approx, pairs=100000, seed=None):
+    """
+        Cosine similarity error of W_approx against the full precision W, over the nonzero rows:
+            self - cosine between each row and its approximation (1 is lossless)
+            pairs - absolute change of the cosine similarity of random pairs of rows
+    """
+    W = np.asarray(W, dtype=np.float64)
+    W_approx = np.asarray(W_approx, dtype=np.float64)
+    norms = np.linalg.norm(W, axis=1)
+    approx_norms = np.linalg.norm(W_approx, axis=1)
+    rows = np.flatnonzero(norms > 0)
+    U = W[rows] / norms[rows, None]
+    V = W_approx[rows] / (approx_norms[rows, None] + 1e-12)
+
+    self_cos = (U * V).sum(axis=1)
+    rng = np.random.RandomState(seed)
+    a, b = rng.randint(len(rows), size=(2, pairs))
+    error = np.abs((U[a] * U[b]).sum(axis=1) - (V[a] * V[b]).sum(axis=1))
+    return {'self_mean': float(self_cos.mean()), 'self_min': float(self_cos.min()),
+            'pair_mean_abs_error': float(error.mean()), 'pair_max_abs_error': float(error.max())}
+
+def precision_report(W, precisions=PRECISIONS, pairs=100000, seed=None):
+    """
+        Size in MB and cosine_error of W stored at each precision
+    """
+    report = {}
+    for precision in precisions:
+        stored = to_precision(W, precision)
+        if precision == 'int8':
+            nbytes = stored[0].nbytes + stored[1].nbytes
+            approx = dequantize_rows(*stored, dtype=np.float64)
+        else:
+            nbytes, approx = stored.nbytes, stored
+        report[precision] = dict(mb=nbytes / 2**20, **cosine_error(W, approx, pairs, seed))
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Size and cosine similarity error of an embedding matrix '
+                                                 'stored at each precision')
+    parser.add_argument('embed_file', nargs='?', default=f'{DATA_DIR}train_device_wiki.npy')
+    parser.add_argument('--pairs', type=int, default=100000)
+    args = parser.parse_args()
+
+    W = read_embeddings(args.embed_file)
+    for precision, r in precision_report(W, pairs=args.pairs, seed=1234).items():
+        print("%-8s %8.1f MB  self cosine mean %.6f min %.6f  pair cosine error mean %.2e max %.2e"
+              % (precision, r['mb'], r['self_mean'], r['self_min'],
+                 r['pair_mean_abs_error'], r['pair_max_abs_error']))
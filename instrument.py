@@ -0,0 +1,128 @@
+'''
+instrument.py
+    Stage instrumentation for the build scripts. Each stage records its
+    wall time, CPU time (including worker processes), peak RSS and the
+    number of records it handled into a JSON run report, and can dump a
+    cProfile of itself
+'''
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+from constants import *
+
+def _maxrss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def _rss_mb():
+    ''' Current resident set size, where /proc is available '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return None
+
+def _cpu_seconds():
+    return sum(r.ru_utime + r.ru_stime for r in
+               (resource.getrusage(resource.RUSAGE_SELF),
+                resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+class StageRecord():
+    ''' Handed to the body of a stage to report how many records it
+        handled, plus anything else worth keeping '''
+
+    def __init__(self, name):
+        self.name = name
+        self.records = None
+        self.extra = {}
+
+    def count(self, n):
+        self.records = (self.records or 0) + int(n)
+
+class RunReport():
+    ''' Stage by stage report of one run of a script, rewritten after
+        every stage so an interrupted run still leaves its report '''
+
+    def __init__(self, script, report_dir=RUN_REPORT_DIR, profile=PROFILE_STAGES):
+        self.script = script
+        self.report_dir = report_dir
+        self.profile = profile or os.environ.get('PROFILE_STAGES', '') not in ('', '0')
+        started = time.strftime('%Y%m%d-%H%M%S')
+        self.path = os.path.join(report_dir, f'{script}_{started}.json')
+        self.run = {'script': script, 'started': started, 'argv': sys.argv, 'stages': []}
+
+    @contextmanager
+    def stage(self, name):
+        ''' Instrument the body of the with block as stage name '''
+        record = StageRecord(name)
+        profiler = cProfile.Profile() if self.profile else None
+        peak_before = _maxrss_mb()
+        cpu = _cpu_seconds()
+        start = time.perf_counter()
+        status = 'failed'
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+            status = 'ok'
+        finally:
+            if profiler:
+                profiler.disable()
+            wall = time.perf_counter() - start
+            result = {
+                'stage': name,
+                'status': status,
+                'wall_seconds': round(wall, 3),
+                'cpu_seconds': round(_cpu_seconds() - cpu, 3),
+                # The peak is the process high-water mark, so a stage
+                # under an earlier peak shows no growth
+                'peak_rss_mb': round(_maxrss_mb(), 1),
+                'peak_rss_growth_mb': round(_maxrss_mb() - peak_before, 1),
+                'peak_worker_rss_mb': round(_maxrss_mb(resource.RUSAGE_CHILDREN), 1),
+                'rss_mb': _rss_mb() and round(_rss_mb(), 1),
+                'records': record.records,
+                'records_per_sec': round(record.records / wall, 1)
+                if record.records and wall else None,
+            }
+            result.update(record.extra)
+            if profiler:
+                result['profile'] = self._dump(profiler, name)
+            self.run['stages'].append(result)
+            self.write()
+            print(f'[{name}] {wall:.1f}s wall, {result["cpu_seconds"]:.1f}s cpu, '
+                  f'peak RSS {result["peak_rss_mb"]:.0f} MB'
+                  + (f', {record.records} records' if record.records is not None else ''))
+
+    def instrument(self, name=None, count=None):
+        ''' Decorator form of stage. count maps the return value to a
+            record count, by default its len() where it has one '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__) as record:
+                    out = func(*args, **kwargs)
+                    if count is not None:
+                        record.count(count(out))
+                    elif hasattr(out, '__len__'):
+                        record.count(len(out))
+                    return out
+            return wrapper
+        return decorator
+
+    def _dump(self, profiler, name):
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = self.path[:-len('.json')] + f'_{name}.prof'
+        profiler.dump_stats(path)
+        return path
+
+    def write(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        self.run['total_wall_seconds'] = round(sum(s['wall_seconds'] for s in self.run['stages']), 3)
+        with open(self.path, 'w') as f:
+            json.dump(self.run, f, indent=1)
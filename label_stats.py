@@ -0,0 +1,126 @@
+'''
+label_stats.py
+    Label frequencies and label-label co-occurrence counts of the
+    training split, and pruning of the label space to the top-K or
+    min-count labels. Pruned splits get their own label matrices and
+    description vectors, sharing the token arrays of the full split
+'''
+import argparse
+import csv
+import json
+import os
+import numpy as np
+from scipy import sparse
+
+from constants import *
+from encode_data import load_encoded, read_labels
+
+def label_statistics(label_matrix, chunk_rows=100000):
+    ''' Label frequencies and co-occurrence counts in one pass over
+        row chunks of the (memory mapped) label matrix.
+        Returns (freq, cooc) where cooc is a CSR matrix with the
+        frequencies on its diagonal
+    '''
+    n_labels = label_matrix.shape[1]
+    indptr, indices = label_matrix.indptr, label_matrix.indices
+    freq = np.zeros(n_labels, dtype=np.int64)
+    cooc = sparse.csr_matrix((n_labels, n_labels), dtype=np.int32)
+
+    for start in range(0, label_matrix.shape[0], chunk_rows):
+        end = min(start + chunk_rows, label_matrix.shape[0])
+        lo, hi = indptr[start], indptr[end]
+        cols = np.asarray(indices[lo:hi])
+        chunk = sparse.csr_matrix((np.ones(len(cols), dtype=np.int32), cols,
+                                   np.asarray(indptr[start:end + 1]) - lo),
+                                  shape=(end - start, n_labels))
+        freq += np.bincount(cols, minlength=n_labels)
+        cooc = cooc + chunk.T.tocsr() @ chunk
+    return freq, cooc.tocsr()
+
+def select_labels(freq, top_k=None, min_count=None):
+    ''' Columns of the labels to keep - the top_k most frequent and/or
+        those seen at least min_count times - in their original order '''
+    keep = np.flatnonzero(freq >= (min_count or 1))
+    if top_k is not None and len(keep) > top_k:
+        # Stable so ties go to the earlier label
+        order = np.argsort(-freq[keep], kind='stable')
+        keep = np.sort(keep[order[:top_k]])
+    return keep
+
+def prune_encoded(encoded_dir, outdir, keep):
+    ''' Write the label matrix of an encoded split restricted to the
+        kept columns. The token arrays are not copied - meta.json points
+        load_encoded at the full split for them
+    '''
+    _, _, _, label_matrix = load_encoded(encoded_dir)
+    pruned = label_matrix[:, keep].tocsr()
+    os.makedirs(outdir, exist_ok=True)
+    np.save(os.path.join(outdir, 'label_indptr.npy'), pruned.indptr)
+    np.save(os.path.join(outdir, 'label_indices.npy'), pruned.indices)
+
+    with open(os.path.join(encoded_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    meta.update({'labels': len(keep),
+                 'tokens_from': os.path.relpath(encoded_dir, outdir)})
+    with open(os.path.join(outdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # Reports left without any of the kept labels
+    return int((np.diff(pruned.indptr) == 0).sum())
+
+def prune_description_vectors(vector_file, outfile, labels):
+    ''' Write one description vector row per label, in the order of
+        labels, so row i matches column i of the pruned label matrices.
+        Labels without a description (rows come from the supplemental
+        data, not labels.csv) get an empty row, as a description without
+        any known token would. Returns the labels written empty
+    '''
+    with open(vector_file, 'r') as f:
+        r = csv.reader(f, delimiter=' ')
+        header = next(r)
+        rows = {row[0]: row for row in r}
+    missing = [l for l in labels if l not in rows]
+    with open(outfile, 'w+') as f:
+        w = csv.writer(f, delimiter=' ')
+        w.writerow(header)
+        w.writerows(rows.get(l, [l]) for l in labels)
+    return missing
+
+def write_statistics(freq, cooc, outdir=LABEL_DIR):
+    np.save(os.path.join(outdir, 'label_freq.npy'), freq)
+    sparse.save_npz(os.path.join(outdir, 'label_cooc.npz'), cooc)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Label statistics of the training split '
+                                                 'and pruning of the label space')
+    parser.add_argument('--top-k', type=int, default=LABEL_TOP_K)
+    parser.add_argument('--min-count', type=int, default=LABEL_MIN_COUNT)
+    parser.add_argument('--name', default='pruned',
+                        help='suffix of the pruned label file, splits and description vectors')
+    args = parser.parse_args()
+
+    l2ind = read_labels()
+    labels = sorted(l2ind, key=l2ind.get)
+    _, _, _, train_labels = load_encoded(f'{DATA_DIR}train_encoded/')
+
+    print(f'Counting {len(labels)} labels over {train_labels.shape[0]} training reports...')
+    freq, cooc = label_statistics(train_labels)
+    write_statistics(freq, cooc)
+    print(f'{int((freq > 0).sum())} labels seen, {cooc.nnz} co-occurring pairs')
+
+    keep = select_labels(freq, args.top_k, args.min_count)
+    kept_labels = [labels[i] for i in keep]
+    share = freq[keep].sum() / max(freq.sum(), 1)
+    print(f'Keeping {len(keep)} labels, covering {share:.1%} of training label occurrences')
+    with open(f'{LABEL_DIR}labels_{args.name}.csv', 'w') as f:
+        f.write('\n'.join(kept_labels) + '\n')
+
+    for split in ('train', 'test', 'dev'):
+        empty = prune_encoded(f'{DATA_DIR}{split}_encoded/',
+                              f'{DATA_DIR}{split}_encoded_{args.name}/', keep)
+        print(f'{split}: {empty} reports left without a label')
+
+    missing = prune_description_vectors(f'{DATA_DIR}description_vectors.vocab',
+                                        f'{DATA_DIR}description_vectors_{args.name}.vocab',
+                                        kept_labels)
+    if missing:
+        print(f'{len(missing)} kept labels have no description, written as empty rows')
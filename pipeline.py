@@ -0,0 +1,287 @@
+'''
+pipeline.py
+    Runs the data build stages in order, skipping every stage whose
+    fingerprint (hashes of its input files, the constants.py parameters
+    it reads and its code) matches the one recorded when its outputs
+    were last built, and whose outputs are unchanged since
+'''
+import argparse
+import ast
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import constants
+from constants import *
+from datafuncs import assemble_archives, file_sha256
+
+STATE_FILE = f'{DATA_DIR}pipeline_state.json'
+ZIP = '*.[zZ][iI][pP]'
+
+class FileHashes():
+    ''' sha256 of files, remembered against their size and modification
+        time so unchanged files (e.g. the raw archives) are only read
+        the first time they are seen '''
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else {}
+
+    def file(self, path):
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = self.cache.get(path)
+        if cached and cached[:2] == key:
+            return cached[2]
+
+        digest = file_sha256(path)
+        self.cache[path] = key + [digest]
+        return digest
+
+    def path(self, path):
+        ''' Hash of a file, or of the names and contents of every file
+            under a directory. None when the path does not exist '''
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return None
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                h.update(os.path.relpath(full, path).encode('utf-8'))
+                h.update(self.file(full).encode('utf-8'))
+        return h.hexdigest()
+
+def local_modules(filename, seen=None):
+    ''' filename and every module of this repo it imports, recursively.
+        constants.py is left out since each stage fingerprints only the
+        parameters it reads '''
+    seen = [] if seen is None else seen
+    if filename in seen:
+        return seen
+    seen.append(filename)
+    with open(filename, 'r') as f:
+        tree = ast.parse(f.read(), filename)
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = name.split('.')[0] + '.py'
+            if module != 'constants.py' and os.path.isfile(module):
+                local_modules(module, seen)
+    return seen
+
+def _path(path):
+    return os.path.normpath(path)
+
+class Stage():
+    ''' One step of the build. run is either a script, run with the
+        current interpreter, or a function. inputs may be glob patterns
+        and outputs may be files or directories '''
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=(), code=()):
+        self.name = name
+        self.run = run
+        self.inputs = [_path(p) for p in inputs]
+        self.outputs = [_path(p) for p in outputs]
+        self.params = list(params)
+        self.code = list(code) or ([run] if isinstance(run, str) else [])
+
+    def input_files(self):
+        ''' Every input path with glob patterns expanded. Raises
+            FileNotFoundError naming anything that does not exist '''
+        paths, missing = [], []
+        for pattern in self.inputs:
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else \
+                [pattern] if os.path.exists(pattern) else []
+            if not matches:
+                missing.append(pattern)
+            paths.extend(matches)
+        if missing:
+            raise FileNotFoundError(f'Stage {self.name} is missing inputs: {missing}')
+        return paths
+
+    def code_files(self):
+        files = []
+        for filename in self.code:
+            local_modules(filename, files)
+        return files
+
+    def fingerprint(self, hashes):
+        ''' sha256 over everything that determines the stage outputs '''
+        payload = {
+            'inputs': {p: hashes.path(p) for p in self.input_files()},
+            'params': {name: repr(getattr(constants, name)) for name in self.params},
+            'code': {f: hashes.file(f) for f in self.code_files()},
+            'outputs': self.outputs,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8'))\
+            .hexdigest()
+
+    def execute(self):
+        if isinstance(self.run, str):
+            subprocess.run([sys.executable, self.run], check=True)
+        else:
+            self.run()
+
+    def depends_on(self, other):
+        ''' Whether any input of this stage is an output of other '''
+        return any(out == p or fnmatch.fnmatch(out, p) or
+                   p.startswith(out + os.sep)
+                   for out in other.outputs for p in self.inputs)
+
+def merge_archives():
+    rows = assemble_archives(RAW_DIR, f'{DATA_DIR}{SOURCE_DATASET}')
+    print(f'Wrote {rows} rows to {DATA_DIR}{SOURCE_DATASET}')
+
+def _splits():
+    names = [f'{DATA_DIR}{split}.csv' for split in ('train', 'test', 'dev')]
+    if WRITE_COLUMNAR:
+        names += [f'{DATA_DIR}{split}/' for split in ('train', 'test', 'dev')]
+    return names
+
+STAGES = [
+    Stage('merge', merge_archives,
+          inputs=[f'{RAW_DIR}{ZIP}'],
+          outputs=[f'{DATA_DIR}{SOURCE_DATASET}'],
+          code=['datafuncs.py']),
+    Stage('assemble', 'assemble_data.py',
+          inputs=[f'{DATA_DIR}{SOURCE_DATASET}'],
+          outputs=[f'{DATA_DIR}post_processed.csv', f'{DATA_DIR}train_raw.csv',
+                   f'{DATA_DIR}{SPLIT_ASSIGNMENTS}'] + _splits(),
+          params=['MAX_LENGTH', 'TRAIN_PROP', 'TEST_PROP', 'VAL_PROP',
+                  'NEAR_DUPLICATES', 'NEAR_DUP_THRESHOLD', 'WRITE_COLUMNAR']),
+    Stage('device', 'assemble_device_data.py',
+          inputs=[f'{DEVICE_DIR}{ZIP}'],
+          outputs=[f'{DATA_DIR}device_data.csv']),
+    Stage('supplemental', 'supplementalData.py',
+          inputs=[f'{LABEL_DIR}labels.csv'],
+          outputs=[f'{DATA_DIR}{SUPPLEMENTAL_DATA}', f'{DATA_DIR}wiki_data.csv']),
+    Stage('embeddings', 'create_embeddings.py',
+          inputs=[f'{DATA_DIR}train_raw.csv', f'{DATA_DIR}device_data.csv',
+                  f'{DATA_DIR}wiki_data.csv', f'{DATA_DIR}{SUPPLEMENTAL_DATA}'],
+          outputs=[f'{DATA_DIR}processed_train_device_wiki.w2v',
+                   f'{VOCAB_DIR}vocab.csv', f'{VOCAB_DIR}doc_freq.json',
+                   f'{DATA_DIR}train_device_wiki.npy', f'{DATA_DIR}train_device_wiki.words',
+                   f'{DATA_DIR}description_vectors.vocab'],
+          params=['MAX_LENGTH', 'EMBEDDING_FILES']),
+    Stage('encode', 'encode_data.py',
+          inputs=_splits() + [f'{VOCAB_DIR}vocab.csv', f'{LABEL_DIR}labels.csv'],
+          outputs=[f'{DATA_DIR}{split}_encoded/' for split in ('train', 'test', 'dev')]),
+    Stage('labels', 'label_stats.py',
+          inputs=[f'{DATA_DIR}{split}_encoded/' for split in ('train', 'test', 'dev')] +
+                 [f'{LABEL_DIR}labels.csv', f'{DATA_DIR}description_vectors.vocab'],
+          outputs=[f'{LABEL_DIR}label_freq.npy', f'{LABEL_DIR}label_cooc.npz',
+                   f'{LABEL_DIR}labels_pruned.csv', f'{DATA_DIR}description_vectors_pruned.vocab'] +
+                  [f'{DATA_DIR}{split}_encoded_pruned/' for split in ('train', 'test', 'dev')],
+          params=['LABEL_MIN_COUNT', 'LABEL_TOP_K']),
+]
+
+def load_state(state_file=STATE_FILE):
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {'files': {}, 'stages': {}}
+
+def save_state(state, state_file=STATE_FILE):
+    # Write then rename so an interrupted run never leaves half a file
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_file + '.tmp', state_file)
+
+def is_current(stage, fingerprint, state, hashes):
+    ''' Same fingerprint as the last build and untouched outputs '''
+    record = state['stages'].get(stage.name)
+    if not record or record['fingerprint'] != fingerprint:
+        return False
+    return all(hashes.path(p) == h for p, h in record['outputs'].items())
+
+def select(stages, names):
+    ''' The named stages plus every earlier stage they depend on '''
+    if not names:
+        return list(stages)
+    unknown = set(names) - set(s.name for s in stages)
+    if unknown:
+        raise ValueError(f'Unknown stages {sorted(unknown)}, expected some of '
+                         f'{[s.name for s in stages]}')
+    wanted = set(names)
+    for stage in reversed(stages):
+        if stage.name in wanted:
+            wanted.update(s.name for s in stages if stage.depends_on(s))
+    return [s for s in stages if s.name in wanted]
+
+def run(stages=STAGES, names=None, force=False, dry_run=False, state_file=STATE_FILE):
+    ''' Run each selected stage whose outputs are out of date, in order.
+        Outputs are hashed after every stage, so a stage downstream of
+        one that rebuilt the same outputs is still skipped.
+        Returns the names of the stages run (or that would be run)
+    '''
+    state = load_state(state_file)
+    hashes = FileHashes(state['files'])
+    ran = []
+
+    for stage in select(stages, names):
+        # A dry run cannot fingerprint what an earlier stage would rebuild
+        after = [s.name for s in stages if s.name in ran and stage.depends_on(s)]
+        if dry_run and after:
+            print(f'{stage.name}: would run after {", ".join(after)}')
+            ran.append(stage.name)
+            continue
+
+        try:
+            fingerprint = stage.fingerprint(hashes)
+        except FileNotFoundError as e:
+            # e.g. the raw archives are elsewhere, but the merged data is here
+            if all(os.path.exists(p) for p in stage.outputs):
+                print(f'{stage.name}: inputs unavailable, keeping existing outputs')
+                continue
+            if dry_run:
+                print(f'{stage.name}: cannot run, {e}')
+                continue
+            raise
+        if not force and is_current(stage, fingerprint, state, hashes):
+            print(f'{stage.name}: up to date')
+            continue
+        ran.append(stage.name)
+        if dry_run:
+            print(f'{stage.name}: would run')
+            continue
+
+        print(f'{stage.name}: running...')
+        # Forget the last build first so a failed run is never current
+        state['stages'].pop(stage.name, None)
+        save_state(state, state_file)
+        start = time.time()
+        stage.execute()
+
+        missing = [p for p in stage.outputs if not os.path.exists(p)]
+        if missing:
+            raise RuntimeError(f'Stage {stage.name} did not write {missing}')
+        state['stages'][stage.name] = {
+            'fingerprint': fingerprint,
+            'outputs': {p: hashes.path(p) for p in stage.outputs},
+            'seconds': round(time.time() - start, 1),
+        }
+        save_state(state, state_file)
+        print(f'{stage.name}: done in {state["stages"][stage.name]["seconds"]}s')
+    return ran
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rebuild the out of date pipeline stages')
+    parser.add_argument('stages', nargs='*',
+                        help=f'stages to bring up to date, of {[s.name for s in STAGES]}')
+    parser.add_argument('--force', action='store_true', help='rerun even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would run')
+    args = parser.parse_args()
+    run(names=args.stages, force=args.force, dry_run=args.dry_run)
@@ -3,14 +3,20 @@ supplementalData.py
     Build a supplemental dataset for descriptions of each label
     in the dataset
 '''
+import os
 import re
+import json
+import time
+import threading
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 import nltk
 import pandas as pd
 import wikipedia
 from tqdm import tqdm
 from constants import *
 from buildVocab import CustAnalyzer
+from instrument import RunReport
 
 
 # Ensure that the punkt package exists
@@ -23,17 +29,205 @@ tokenizer = nltk.data.load('tokenizers/punkt/english.pickle').tokenize
 reg = re.compile(r'.*\((medi\w*)\)', re.I)
 chars = re.compile(r'[\x00-\x1f]+')
 
+class SearchStats():
+    ''' Thread-safe record of the searches - how many ended in each
+        outcome, page source latencies, cache hits and throughput '''
+
+    # Upper bounds in seconds of the latency histogram buckets
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        ''' Zero every statistic and restart the clock, at the start of
+            a search run '''
+        self.start = time.monotonic()
+        self.counts = {
+            'original': 0,
+            'disambiguation': 0,
+            'trimmed': 0,
+            'trimmed_disambiguation': 0,
+            'failed': 0,
+            'total_searches': 0,
+            'labels': 0,
+            'cache_hits': 0,
+            'cache_misses': 0
+        }
+        self.latency_counts = [0] * len(self.LATENCY_BUCKETS)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def record_latency(self, seconds):
+        ''' Record the time taken by one page source lookup '''
+        bucket = next(i for i, b in enumerate(self.LATENCY_BUCKETS) if seconds <= b)
+        with self.lock:
+            self.latency_counts[bucket] += 1
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+
+    def latency_quantile(self, q):
+        ''' Upper bound of the histogram bucket holding quantile q,
+            or the slowest lookup for the open-ended last bucket '''
+        total = sum(self.latency_counts)
+        seen = 0
+        for bound, n in zip(self.LATENCY_BUCKETS, self.latency_counts):
+            seen += n
+            if total and seen >= q * total:
+                return min(bound, self.latency_max)
+        return None
+
+    def histogram(self):
+        ''' Latency bucket labels mapped to their counts '''
+        labels = [f'<={b}s' for b in self.LATENCY_BUCKETS[:-1]]
+        labels.append(f'>{self.LATENCY_BUCKETS[-2]}s')
+        return dict(zip(labels, self.latency_counts))
+
+    def report(self):
+        ''' Snapshot of every statistic as a JSON friendly dict '''
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            counts = dict(self.counts)
+            lookups = sum(self.latency_counts)
+            cached = counts['cache_hits'] + counts['cache_misses']
+            return {
+                'counts': counts,
+                'cache_hit_ratio': counts['cache_hits'] / cached if cached else None,
+                'elapsed_seconds': elapsed,
+                'labels_per_second': counts['labels'] / elapsed if elapsed else None,
+                'searches_per_second': counts['total_searches'] / elapsed if elapsed else None,
+                'latency': {
+                    'lookups': lookups,
+                    'mean_seconds': self.latency_total / lookups if lookups else None,
+                    'max_seconds': self.latency_max,
+                    'p50_seconds': self.latency_quantile(0.5),
+                    'p95_seconds': self.latency_quantile(0.95),
+                    'histogram': self.histogram()
+                }
+            }
+
+    def write(self, outfile):
+        ''' Write the report out as JSON '''
+        with open(outfile, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
 # Tracker for which search is returned
-tracker = {
-    'original': 0,
-    'disambiguation': 0,
-    'trimmed': 0,
-    'trimmed_disambiguation': 0,
-    'failed': 0,
-    'total_searches': 0
-}
-
-def search_wiki(text, sent_detector=tokenizer):
+tracker = SearchStats()
+
+def wikipedia_summary(title):
+    ''' Default page source - summary of the live Wikipedia page.
+        A page source takes a search term and returns the page summary,
+        raising wikipedia.PageError or wikipedia.DisambiguationError
+    '''
+    return wikipedia.WikipediaPage(title = title).summary
+
+class RateLimiter():
+    ''' Spaces out calls from any number of threads to at most
+        rate per second '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_call)
+            self.next_call = start + self.interval
+        time.sleep(max(0, start - now))
+
+class WikiFetcher():
+    ''' Looks up search terms through a pluggable page source. Outcomes
+        (page, disambiguation or missing page) are cached by search term
+        and appended to cache_file as they arrive, so a rerun, even after
+        a crash mid-run, only searches terms it has not seen. Unexpected
+        errors are not cached so those terms are retried
+    '''
+
+    def __init__(self, source=wikipedia_summary, cache_file=None, rate=None,
+                 stats=tracker):
+        self.source = source
+        self.stats = stats
+        self.cache_file = cache_file
+        self.limiter = RateLimiter(rate) if rate else None
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.pending = {}
+
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial line from an interrupted run
+                        continue
+                    self.cache[entry['term']] = (entry['kind'], entry['value'])
+
+    def lookup(self, term):
+        ''' Returns ('page', summary), ('disambiguation', options)
+            or ('missing', None) '''
+        with self.lock:
+            if term in self.cache:
+                self.stats.add('cache_hits')
+                return self.cache[term]
+            # Another thread already searching this term
+            searching = self.pending.get(term)
+            if searching is None:
+                self.pending[term] = threading.Event()
+
+        if searching is not None:
+            searching.wait()
+            return self.lookup(term)
+
+        try:
+            self.stats.add('cache_misses')
+            if self.limiter:
+                self.limiter.wait()
+            start = time.monotonic()
+            try:
+                outcome = ('page', self.source(term))
+            except wikipedia.DisambiguationError as e:
+                outcome = ('disambiguation', e.options)
+            except wikipedia.PageError:
+                outcome = ('missing', None)
+            finally:
+                self.stats.record_latency(time.monotonic() - start)
+
+            with self.lock:
+                self.cache[term] = outcome
+                if self.cache_file:
+                    with open(self.cache_file, 'a') as f:
+                        f.write(json.dumps({'term': term, 'kind': outcome[0],
+                                            'value': outcome[1]}) + '\n')
+            return outcome
+        finally:
+            with self.lock:
+                self.pending.pop(term).set()
+
+    def summary(self, term):
+        ''' Page summary for term, raising the wikipedia exceptions
+            the page source would have '''
+        kind, value = self.lookup(term)
+        if kind == 'disambiguation':
+            raise wikipedia.DisambiguationError(term, value)
+        elif kind == 'missing':
+            raise wikipedia.PageError(None, term)
+        return value
+
+# Uncached fetcher used unless one is passed in
+fetcher = WikiFetcher()
+
+def search_wiki(text, sent_detector=tokenizer, fetcher=fetcher):
     ''' Wrapper for the search call to Wikipedia
         Additionally splits by setence and only returns the first one'''
     
@@ -42,17 +236,15 @@ def search_wiki(text, sent_detector=tokenizer):
            "Argument sent_detector must be a callable"
     
     # Mark that a search occured
-    tracker['total_searches'] += 1
+    fetcher.stats.add('total_searches')
     
     # Run the search
-    desc = chars.sub(' ',
-                     wikipedia.WikipediaPage(title = text).summary
-    )
+    desc = chars.sub(' ', fetcher.summary(text))
     
     # Split by setences and return the first one
     return sent_detector(desc)[0], desc
 
-def get_wiki_desc(text, original_term=None):
+def get_wiki_desc(text, original_term=None, fetcher=fetcher):
     ''' Returns tuple of the original text label and its 
         scraped description. The methodology for finding 
         a description is as follows:
@@ -87,12 +279,12 @@ def get_wiki_desc(text, original_term=None):
         
     # Search wikipedia
     try:
-        desc, summary = search_wiki(text)
-        # Update the tracker
+        desc, summary = search_wiki(text, fetcher=fetcher)
+        # Update the search stats
         if trimmed:
-            tracker['trimmed'] += 1
+            fetcher.stats.add('trimmed')
         else:
-            tracker['original'] += 1
+            fetcher.stats.add('original')
         # Segment setentences and use first one
         return original_term, desc, summary
     
@@ -120,24 +312,24 @@ def get_wiki_desc(text, original_term=None):
         if new_term:
             # Search the disamgiuation term
             try:
-                desc, summary = search_wiki(new_term)
-                # Update the tracker
+                desc, summary = search_wiki(new_term, fetcher=fetcher)
+                # Update the search stats
                 if trimmed:
-                    tracker['trimmed_disambiguation'] += 1
+                    fetcher.stats.add('trimmed_disambiguation')
                 else:
-                    tracker['disambiguation'] += 1
+                    fetcher.stats.add('disambiguation')
                 return original_term, desc, summary
             except Exception as e:
                 # This shouldn't happen but this takes a while so I don't
                 # want a failure at term 10000
                 print(f"Disambiguation failed!!! Search term: {alt}")
                 print(f'\tError: {e}')
-                tracker['failed'] += 1
+                fetcher.stats.add('failed')
                 return original_term, original_term, original_term
                 
         # Too ambiguous so stick with just returning the label
         else:
-            tracker['failed'] += 1
+            fetcher.stats.add('failed')
             return original_term, original_term, original_term
     
     # No page found so trim
@@ -149,49 +341,49 @@ def get_wiki_desc(text, original_term=None):
             # Trim the last word off the text
             text = ' '.join(text.split(' ')[:-1])
             # Recursive search
-            return get_wiki_desc(text, original_term)
+            return get_wiki_desc(text, original_term, fetcher)
             
         else:
             # Text was already trimmed or nothing to trim so search has failed
-            tracker['failed'] += 1
+            fetcher.stats.add('failed')
             return original_term, original_term, original_term
     except Exception as e:
         print(f'Unexpected failure on term {original_term}')
         print(f'\tError: {e}')
-        tracker['failed'] += 1
+        fetcher.stats.add('failed')
         return original_term, original_term, original_term
 
-def build_supplemental_data(label_list, sent_detector=None):
+def build_supplemental_data(label_list, sent_detector=None, fetcher=fetcher,
+                            n_workers=8):
     ''' Iterate a list of labels and assemble the 
-        supplemental dataset.
+        supplemental dataset. Labels are searched concurrently
+        by n_workers threads, keeping the order of label_list.
         Returns pandas.DataFrame
     '''
     
     # Initialize a dictionary to hold observations
     data_dict = {'label': [], 'desc':[], 'summary': []}
+
+    # Rates are measured from the start of the search
+    fetcher.stats.reset()
     
-    # Counter
-    i = 0
-    
-    # Loop the input list
-    for label in tqdm(label_list):
-        # Search the term
-        label, desc, summary = get_wiki_desc(label)
-        # Add to the dictionary
-        data_dict['label'] += [label]
-        data_dict['desc'] += [desc]
-        data_dict['summary'] += [summary]
-        
-        # Increment counter
-        i += 1
-        
-        # Mark progress
-        # print(f'Completed {i} searches', end="\r")
+    # Search the terms, results come back in input order
+    with ThreadPoolExecutor(n_workers) as pool:
+        results = pool.map(lambda label: get_wiki_desc(label, fetcher=fetcher),
+                           label_list)
+        for label, desc, summary in tqdm(results, total=len(label_list)):
+            # Add to the dictionary
+            data_dict['label'] += [label]
+            data_dict['desc'] += [desc]
+            data_dict['summary'] += [summary]
+            fetcher.stats.add('labels')
         
     # Return as a data frame
     return pd.DataFrame(data_dict)
 
 if __name__ == "__main__":
+    report = RunReport('supplementalData')
+
     # Open the label set and store as list
     with open(f'{LABEL_DIR}labels.csv', 'r') as f:
         labels = [x.replace('\n', '') for x in f.readlines()]
@@ -200,8 +392,13 @@ if __name__ == "__main__":
 
     print(f'Found {len(labels)} labels to search.')
     print(f'Starting search at {start_time.strftime("%T")}...')
-    # Build the supplemental dataset
-    sup_data = build_supplemental_data(labels, tokenizer)
+    # Build the supplemental dataset, caching every search so a rerun
+    # picks up where the last one stopped
+    wiki_fetcher = WikiFetcher(cache_file=f'{DATA_DIR}wiki_cache.jsonl', rate=10)
+    with report.stage('search') as stage:
+        sup_data = build_supplemental_data(labels, tokenizer, fetcher=wiki_fetcher)
+        stage.count(len(labels))
+        stage.extra['cache_hit_ratio'] = wiki_fetcher.stats.report()['cache_hit_ratio']
 
     # Write out to tab delemitted text
     sup_data.drop(['summary'], axis=1)\
@@ -210,8 +407,9 @@ if __name__ == "__main__":
 
     # Pre-process the supplemental data summaries
     tokenize = CustAnalyzer(mask_dates=True, max_length=None)
-    sup_data['summary'] = sup_data.summary\
-        .apply(lambda x: ' '.join(tokenize(x)))
+    with report.stage('tokenize') as stage:
+        sup_data['summary'] = [' '.join(x) for x in tokenize.batch(sup_data.summary)]
+        stage.count(sup_data.shape[0])
     # Write out to tab delemitted text
     sup_data.drop(['desc'], axis=1)\
         .to_csv(f'{DATA_DIR}wiki_data.csv',
@@ -219,10 +417,12 @@ if __name__ == "__main__":
 
     # Calculate end time
     total_time = dt.datetime.now() - start_time
-    # Report the tracker
+    # Report the search stats
     print(' ' * 100)
     print('Data assembly complete')
     print(f"Total runtime: {str(total_time).split('.', 2)[0]}")
     print('Summary of search results:')
-    print(tracker)
+    print(wiki_fetcher.stats.counts)
+    # Full report next to the supplemental data
+    wiki_fetcher.stats.write(f'{DATA_DIR}supplement_data_stats.json')
 
@@ -0,0 +1,54 @@
+'''
+test_buildVocab.py
+    Regression tests for buildVocab.py, run with pytest
+'''
+import pandas as pd
+
+import buildVocab
+from buildVocab import build_vocab, load_doc_freq, merge_doc_freq, update_vocab
+
+WORDS = ['fever', 'rash', 'headache', 'nausea', 'chills', 'fatigue', 'pain', 'swelling']
+
+def release(path, ids):
+    ''' A train_raw.csv style file holding the reports ids, in id order '''
+    pd.DataFrame({
+        'VAERS_ID': ids,
+        'RAW_TEXT': [' '.join(WORDS[(i * k) % len(WORDS)] for k in (1, 3, 5)) for i in ids],
+    }).to_csv(path, index=False)
+
+def counting(monkeypatch):
+    ''' Record every document the analyzer counts '''
+    counted = []
+    count_doc_freq = buildVocab.count_doc_freq
+    def spy(docs, analyzer, doc_freq=None):
+        counted.extend(docs)
+        return count_doc_freq(docs, analyzer, doc_freq)
+    monkeypatch.setattr(buildVocab, 'count_doc_freq', spy)
+    return counted
+
+def test_update_counts_only_new_reports(tmp_path, monkeypatch):
+    corpus, store = str(tmp_path / 'train_raw.csv'), str(tmp_path / 'doc_freq.json')
+    release(corpus, list(range(1, 41)))
+    build_vocab({corpus: 1}, n_jobs=1, min_df=3, store=store)
+
+    # The next release rewrites the file with the whole history
+    release(corpus, list(range(1, 41)) + list(range(100, 110)))
+    counted = counting(monkeypatch)
+    vocab, _, _ = update_vocab({corpus: 1}, store=store, outfile=None, min_df=3, n_jobs=1)
+    assert len(counted) == 10
+
+    full_store = str(tmp_path / 'full.json')
+    full, _ = build_vocab({corpus: 1}, n_jobs=1, min_df=3, store=full_store)
+    assert full and vocab == full
+    assert merge_doc_freq(load_doc_freq(store)[0]) == merge_doc_freq(load_doc_freq(full_store)[0])
+
+def test_update_recounts_when_reports_are_removed(tmp_path, monkeypatch):
+    corpus, store = str(tmp_path / 'train_raw.csv'), str(tmp_path / 'doc_freq.json')
+    release(corpus, list(range(1, 41)))
+    build_vocab({corpus: 1}, n_jobs=1, min_df=3, store=store)
+
+    release(corpus, list(range(5, 45)))
+    counted = counting(monkeypatch)
+    vocab, _, _ = update_vocab({corpus: 1}, store=store, outfile=None, min_df=3, n_jobs=1)
+    assert len(counted) == 40
+    assert vocab == build_vocab({corpus: 1}, n_jobs=1, min_df=3)[0]
@@ -0,0 +1,125 @@
+'''
+test_datafuncs.py
+    Regression tests for datafuncs.py, run with pytest
+'''
+import numpy as np
+import pandas as pd
+
+from datafuncs import aggregate_symptoms, assign_splits, group_splits, load_columnar, read_assignments, \
+    read_data, split_tokens, write_assignments, write_columnar
+from encode_data import encode_label_ids, encode_labels
+
+def join_symptoms(row):
+    ''' The original row by row symptom join of assemble_data.py '''
+    out = []
+    for i in range(1,6):
+        if not pd.isna(row[f'SYMPTOM{i}']):
+            out.append(row[f'SYMPTOM{i}'])
+    return out
+
+def legacy_aggregate(compiled):
+    ''' The original apply(join_symptoms) and groupby sum aggregation '''
+    compiled = compiled.copy()
+    compiled['SYMPTOMS'] = compiled.apply(join_symptoms, axis=1)
+    codes = compiled.groupby(['VAERS_ID'])['SYMPTOMS'].agg('sum').reset_index()
+    codes['LABELS'] = codes.SYMPTOMS.apply(lambda x: ';'.join(x))
+    return codes
+
+def compiled_fixture():
+    ''' Merged archive rows, with reports split over several SYMPTOM rows
+        (in and out of order), reports without any coded symptom and gaps
+        between the filled SYMPTOM columns '''
+    rows = [
+        (3, 'third', ['Rash', 'Fever', None, None, None]),
+        (1, 'first', ['Pyrexia', 'Chills', 'Headache', 'Nausea', 'Fatigue']),
+        (2, 'no codes', [None, None, None, None, None]),
+        (1, 'first', ['Myalgia', None, None, None, None]),
+        (4, 'gaps', [None, 'Dizziness', None, 'Syncope', None]),
+        (3, 'third', ['Pruritus', None, None, None, None]),
+        (1, 'first', ['Vomiting', 'Arthralgia', None, None, None]),
+        (5, 'single', ['Injection site pain', None, None, None, None]),
+    ]
+    data = {'VAERS_ID': [r[0] for r in rows], 'SYMPTOM_TEXT': [r[1] for r in rows]}
+    for i in range(5):
+        data[f'SYMPTOM{i + 1}'] = [r[2][i] if r[2][i] is not None else np.nan for r in rows]
+        data[f'SYMPTOMVERSION{i + 1}'] = [23.1 if r[2][i] is not None else np.nan for r in rows]
+    return pd.DataFrame(data)
+
+def test_aggregate_symptoms_matches_legacy():
+    compiled = compiled_fixture()
+    expected = legacy_aggregate(compiled)
+    codes = aggregate_symptoms(compiled)
+
+    assert codes.VAERS_ID.tolist() == expected.VAERS_ID.tolist()
+    assert codes.SYMPTOMS.tolist() == expected.SYMPTOMS.tolist()
+    assert codes.LABELS.tolist() == expected.LABELS.tolist()
+
+def test_aggregate_symptoms_keeps_row_then_column_order():
+    codes = aggregate_symptoms(compiled_fixture()).set_index('VAERS_ID')
+
+    assert codes.loc[1, 'SYMPTOMS'] == ['Pyrexia', 'Chills', 'Headache', 'Nausea',
+                                        'Fatigue', 'Myalgia', 'Vomiting', 'Arthralgia']
+    assert codes.loc[2, 'SYMPTOMS'] == []
+    assert codes.loc[2, 'LABELS'] == ''
+    assert codes.loc[4, 'LABELS'] == 'Dizziness;Syncope'
+
+def split_fixture():
+    ''' A split with an empty report, an unlabelled one, repeated labels,
+        non-ascii text and stray whitespace '''
+    return pd.DataFrame({
+        'VAERS_ID': [5, 6, 7, 8, 9],
+        'TEXT': ['rash on arm', '', 'fièvre  légère', 'x', ' pain site '],
+        'LABELS': ['Rash;Pyrexia', '', 'Pyrexia;Rash;Rash', 'Unknown', 'Pain'],
+    })
+
+def test_columnar_reads_like_csv(tmp_path):
+    df = split_fixture()
+    df.to_csv(tmp_path / 'split.csv')
+    write_columnar(df, str(tmp_path / 'split'))
+    columns = ['VAERS_ID', 'TEXT', 'LABELS']
+
+    pd.testing.assert_frame_equal(read_data(str(tmp_path / 'split'), columns),
+                                  read_data(str(tmp_path / 'split.csv'), columns))
+
+def test_columnar_arrays_encode_like_rows(tmp_path):
+    df = split_fixture()
+    write_columnar(df, str(tmp_path / 'split'))
+    columns = load_columnar(str(tmp_path / 'split'), ['TEXT', 'LABELS'])
+
+    tokens, offsets = split_tokens(*columns['TEXT'])
+    expected = [t.split() for t in df.TEXT]
+    assert tokens == [t for doc in expected for t in doc]
+    assert offsets.tolist() == [0, 3, 3, 5, 6, 8]
+
+    l2ind = {'Pain': 0, 'Pyrexia': 1, 'Rash': 2}
+    labels = encode_label_ids(*columns['LABELS'], l2ind)
+    assert (labels != encode_labels(df.LABELS, l2ind)).nnz == 0
+
+def test_bridging_follow_up_keeps_old_splits(tmp_path):
+    # Two near-duplicate groups whose lowest ids hash to different splits
+    hashed = assign_splits(np.arange(1, 1000))
+    a = 1
+    b = 1 + int(np.flatnonzero(hashed != hashed[0])[0])
+    ids = np.array([a, b, a + 1000, b + 1000])
+    split = group_splits(ids, np.array([0, 1, 0, 1]))
+    assert split.tolist() == [hashed[0], hashed[b - 1]] * 2
+    write_assignments(str(tmp_path / 'splits.csv'), ids, split)
+
+    # The next release has a follow up (id 5000) linking both groups
+    assigned = read_assignments(str(tmp_path / 'splits.csv'))
+    bridged = np.append(ids, 5000)
+    groups = np.zeros(len(bridged), dtype=np.int64)
+    # Rehashing the merged group would move group b
+    assert (group_splits(bridged, groups)[:4] != split).any()
+
+    new_split = group_splits(bridged, groups, assigned)
+    assert new_split[:4].tolist() == split.tolist()
+    assert new_split[4] == split[0]
+
+    # New groups still hash their lowest id, and old reports stay put
+    # when missing from a release
+    write_assignments(str(tmp_path / 'splits.csv'), bridged[1:], new_split[1:], assigned)
+    assigned = read_assignments(str(tmp_path / 'splits.csv'))
+    assert assigned[a] == split[0] and assigned[5000] == split[0]
+    fresh = group_splits(np.array([7000, 7001]), np.array([3, 3]), assigned)
+    assert fresh.tolist() == [assign_splits([7000])[0]] * 2
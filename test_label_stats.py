@@ -0,0 +1,21 @@
+'''
+test_label_stats.py
+    Regression tests for label_stats.py, run with pytest
+'''
+from label_stats import prune_description_vectors
+from vector_index import read_description_vectors
+
+def test_pruned_vectors_stay_aligned_with_labels(tmp_path):
+    vector_file, outfile = str(tmp_path / 'vectors.vocab'), str(tmp_path / 'pruned.vocab')
+    with open(vector_file, 'w') as f:
+        f.write('CODE VECTOR\nRash 4 7\nPyrexia 2\nPain 9 9 1\n')
+
+    # Headache is a kept label without a supplemental description
+    kept = ['Pain', 'Headache', 'Rash']
+    missing = prune_description_vectors(vector_file, outfile, kept)
+
+    assert missing == ['Headache']
+    keys, ids, offsets = read_description_vectors(outfile)
+    assert keys == kept
+    assert ids.tolist() == [9, 9, 1, 4, 7]
+    assert offsets.tolist() == [0, 3, 3, 5]
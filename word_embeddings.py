@@ -3,6 +3,9 @@
 """
 import gensim.models.word2vec as w2v
 import csv
+import inspect
+import json
+import os
 
 from constants import *
 
@@ -19,7 +22,43 @@ class ProcessedIter(object):
                 for row in r:
                     yield (row[value].split())
 
-def word_embeddings(embed_name, file_dict, embedding_size, min_count, n_iter):
+def build_corpus_file(filedict, corpus_file):
+    ''' Parse the text columns once into a LineSentence style file,
+        one space separated document per line, so training passes
+        never re-parse the CSVs. The file is reused while it is newer
+        than every source and was built from the same file dictionary
+    '''
+    sources_file = corpus_file + '.sources.json'
+    sources = dict(filedict)
+
+    if os.path.isfile(corpus_file) and os.path.isfile(sources_file):
+        with open(sources_file, 'r') as f:
+            cached = json.load(f)
+        newest = max(os.path.getmtime(key) for key in filedict)
+        if cached == sources and os.path.getmtime(corpus_file) >= newest:
+            print("reusing corpus cache %s" % (corpus_file))
+            return corpus_file
+
+    print("building corpus cache %s..." % (corpus_file))
+    with open(corpus_file, 'w') as out:
+        for tokens in ProcessedIter(None, filedict):
+            out.write(' '.join(tokens) + '\n')
+    with open(sources_file, 'w') as f:
+        json.dump(sources, f)
+    return corpus_file
+
+def supports_corpus_file():
+    ''' corpus_file training was added in gensim 3.6 '''
+    return 'corpus_file' in inspect.signature(w2v.Word2Vec.__init__).parameters
+
+def word2vec_args(embedding_size, n_iter):
+    ''' Word2Vec size and iteration arguments - gensim 4 renamed size to
+        vector_size and iter to epochs '''
+    if 'vector_size' in inspect.signature(w2v.Word2Vec.__init__).parameters:
+        return {'vector_size': embedding_size, 'epochs': n_iter}
+    return {'size': embedding_size, 'iter': n_iter}
+
+def word_embeddings(embed_name, file_dict, embedding_size, min_count, n_iter, workers=4):
     """
     embed_name: the embedding name you want the file saved as.  File willbe saved as "processed_{embed_name}.w2v"
     file_dict: a dictionary of files and the index of the text column.  To configure:
@@ -30,6 +69,8 @@ def word_embeddings(embed_name, file_dict, embedding_size, min_count, n_iter):
     embedding_size: default in paper is 100
     min_count: default in paper is 3
     n_iter: default in paper is 5
+    workers: number of training threads. The text is parsed once into a cached
+        corpus_{embed_name}.txt, which gensim >= 3.6 trains on in corpus_file mode
     
     
     Sample execution code:
@@ -40,15 +81,22 @@ def word_embeddings(embed_name, file_dict, embedding_size, min_count, n_iter):
     
     """
     modelname = "processed_%s.w2v" % (embed_name)
-    sentences = ProcessedIter(embed_name, file_dict)
+    corpus_file = build_corpus_file(file_dict, f'{DATA_DIR}corpus_{embed_name}.txt')
 
-    model = w2v.Word2Vec(size=embedding_size, min_count=min_count, workers=4, iter=n_iter)
     print("building word2vec vocab on %s..." % (list(file_dict.keys())))
-    
-    model.build_vocab(sentences)
-    print("training...")
-    model.train(sentences, total_examples=model.corpus_count, epochs=model.iter)
+    if supports_corpus_file():
+        # Each worker reads its own slice of the file, outside the GIL
+        print("training...")
+        model = w2v.Word2Vec(corpus_file=corpus_file, min_count=min_count, workers=workers,
+                             **word2vec_args(embedding_size, n_iter))
+    else:
+        sentences = w2v.LineSentence(corpus_file)
+        model = w2v.Word2Vec(min_count=min_count, workers=workers,
+                             **word2vec_args(embedding_size, n_iter))
+        model.build_vocab(sentences)
+        print("training...")
+        model.train(sentences, total_examples=model.corpus_count, epochs=n_iter)
     out_file = f'{DATA_DIR}{modelname}'
     print("writing embeddings to %s" % (out_file))
     model.save(out_file)
-    return out_file
\ No newline at end of file
+    return out_file